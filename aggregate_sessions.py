@@ -0,0 +1,138 @@
+import numpy as np
+import data_util
+import trial_util
+import session_cache
+import session_meta
+import profiling
+import pathlib
+import argparse
+
+from plot_util import DATA_DIR
+from plot_batch import run_pool
+
+def session_trials(session, datadir=DATA_DIR):
+    """ columns of the trials to the targets (not the returns to the center) of one session. the per-trial metrics are
+    cached by session_cache, so only new or changed sessions are read """
+    data_path = pathlib.Path(datadir) / session
+    tables = session_cache.load_session_tables(data_path)
+    meta = session_meta.load_meta(data_path)
+    keep = tables['target'] != trial_util.CENTER_STATE
+    n = int(np.sum(keep))
+    copilot_alpha = np.nan if meta.copilot_alpha is None else meta.copilot_alpha
+    return {
+        'session': np.full(n, session),
+        'participant': np.full(n, meta.participant or ''),
+        'date': np.full(n, np.datetime64(meta.date) if meta.date is not None else np.datetime64('NaT'), dtype='datetime64[D]'),
+        'target': np.asarray(tables['target'][keep], dtype='int64'),
+        'copilot': np.full(n, copilot_alpha == 0.0),
+        'copilot_alpha': np.full(n, copilot_alpha),
+        'target_dia': np.full(n, tables['target_dia']),
+        'path_efficiency': np.asarray(tables['path_efficiency'][keep], dtype='float64'),
+        'path_length': np.asarray(tables['path_length'][keep], dtype='float64'),
+        'duration': np.asarray(tables['duration'][keep], dtype='float64'), # in task samples
+    }
+
+COLUMNS = ['session', 'participant', 'date', 'week', 'target', 'copilot', 'copilot_alpha', 'target_dia',
+           'path_efficiency', 'path_length', 'duration']
+
+@profiling.traced('aggregate_sessions.build_table')
+def build_table(sessions, datadir=DATA_DIR, workers=None):
+    """ one columnar table (dict of equal-length arrays with keys COLUMNS) of the trials of all sessions, with the
+    sessions loaded over a process pool. sessions that fail to load are reported and left out """
+    parts = run_pool({session: (session_trials, session, datadir) for session in sessions}, workers, keep_failed=False)
+    parts = list(parts.values())
+    if len(parts) == 0:
+        raise ValueError('none of the sessions could be loaded')
+    table = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+    table['week'] = table['date'].astype('datetime64[W]')
+    return {name: table[name] for name in COLUMNS}
+
+@profiling.traced('aggregate_sessions.channel_stats')
+def channel_stats(sessions, datadir=DATA_DIR, label='eeg', data_filter=None, covariance=True, workers=None):
+    """ data_util.RunningStats of one label of eeg.bin over all the sessions, e.g. to z-score every session with the
+    same per-channel mean and std. every session is read once, in one pass, in a worker process, and the per-session
+    stats are merged. returns the merged stats and the dict of per-session stats """
+    per_session = run_pool({session: (data_util.channel_stats, pathlib.Path(datadir) / session / 'eeg.bin', label, data_filter,
+                                      covariance) for session in sessions}, workers, keep_failed=False)
+    stats = data_util.RunningStats(covariance)
+    for session_stats in per_session.values():
+        stats.merge(session_stats)
+    return stats, per_session
+
+def select(table, mask):
+    """ the rows of table where mask is True """
+    return {name: column[mask] for name, column in table.items()}
+
+def group_stats(table, by, value='path_efficiency'):
+    """ count, mean, std (population) and sem of the finite values of column value, for every combination of the columns
+    in by. returns a columnar dict with the by columns (one row per group, sorted) and count, mean, std and sem """
+    finite = np.isfinite(table[value])
+    keys = np.empty(int(np.sum(finite)), dtype=[(name, table[name].dtype) for name in by])
+    for name in by:
+        keys[name] = table[name][finite]
+    groups, inverse = np.unique(keys, return_inverse=True)
+    stats = trial_util.group_by_target(inverse, table[value][finite])
+    out = {name: groups[name] for name in by}
+    out['count'] = stats['count']
+    out['mean'] = stats['mean']
+    out['std'] = stats['std']
+    out['sem'] = stats['std']/np.sqrt(np.maximum(stats['count'] - 1, 1))
+    return out
+
+def holm(p):
+    """ Holm-Bonferroni adjusted p values """
+    p = np.asarray(p, dtype='float64')
+    order = np.argsort(p)
+    adjusted = np.maximum.accumulate(p[order]*(len(p) - np.arange(len(p))))
+    out = np.empty(len(p))
+    out[order] = np.minimum(adjusted, 1.0)
+    return out
+
+def pairwise_tests(stats):
+    """ Welch's t-test between every pair of groups of group_stats, computed for all pairs at once from the group
+    counts, means and stds. returns a columnar dict with group_a, group_b (row indices into stats), diff (mean of a minus
+    mean of b), t, df, p and p_holm (adjusted over all pairs) """
+    from scipy.stats import t as t_dist # only loaded when testing
+    n = np.asarray(stats['count'], dtype='float64')
+    var = stats['std']**2*n/np.maximum(n - 1, 1) # sample variance
+    a, b = np.triu_indices(len(n), k=1)
+    se2_a, se2_b = var[a]/n[a], var[b]/n[b]
+    diff = stats['mean'][a] - stats['mean'][b]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = diff/np.sqrt(se2_a + se2_b)
+        df = (se2_a + se2_b)**2/(se2_a**2/np.maximum(n[a] - 1, 1) + se2_b**2/np.maximum(n[b] - 1, 1))
+    p = 2*t_dist.sf(np.abs(t), df)
+    return {'group_a': a, 'group_b': b, 'diff': diff, 't': t, 'df': df, 'p': p, 'p_holm': holm(p)}
+
+def group_label(stats, i, by):
+    return ' '.join(f'{name}={stats[name][i]}' for name in by)
+
+if __name__ == '__main__':
+    from plot_batch import find_sessions, filter_sessions
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sessions', nargs='+', help='session names or glob patterns, e.g. "2024-*_H1_CL_*"')
+    parser.add_argument('--datadir', default=str(DATA_DIR), help='folder containing the session folders')
+    parser.add_argument('--by', nargs='+', default=['participant', 'copilot'], help=f'columns to group by, from {COLUMNS}')
+    parser.add_argument('--value', default='path_efficiency', help='column to compare between the groups')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: number of cpus)')
+    parser.add_argument('--participant', default=None, help='only sessions of this participant, e.g. H1')
+    parser.add_argument('--out', default=None, help='save the trials table in the columnar format of data_util.write_columnar')
+    profiling.add_argument(parser)
+
+    args = parser.parse_args()
+    profiling.from_args(args)
+    sessions = filter_sessions(find_sessions(args.sessions, args.datadir), args.datadir, participant=args.participant)
+    table = build_table(sessions, args.datadir, args.workers)
+    if args.out is not None:
+        data_util.write_columnar({'labels': COLUMNS, **table}, args.out, name='trials')
+    stats = group_stats(table, args.by, args.value)
+    print(f'{len(table["session"])} trials of {len(np.unique(table["session"]))} sessions\n')
+    print(f'{"group":<40}{"count":>7}{"mean":>10}{"std":>10}{"sem":>10}')
+    for i in range(len(stats['count'])):
+        print(f'{group_label(stats, i, args.by):<40}{stats["count"][i]:>7}{stats["mean"][i]:>10.2f}{stats["std"][i]:>10.2f}{stats["sem"][i]:>10.2f}')
+    if len(stats['count']) > 1:
+        tests = pairwise_tests(stats)
+        print(f'\n{"group a":<32}{"group b":<32}{"diff":>9}{"t":>8}{"p":>10}{"p holm":>10}')
+        for k in np.argsort(tests['p']):
+            print(f'{group_label(stats, tests["group_a"][k], args.by):<32}{group_label(stats, tests["group_b"][k], args.by):<32}'
+                  f'{tests["diff"][k]:>9.2f}{tests["t"][k]:>8.2f}{tests["p"][k]:>10.3g}{tests["p_holm"][k]:>10.3g}')
@@ -3,22 +3,19 @@ import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.collections
 import data_util
+import trial_util
+
+from plot_util import add_trajectories
 
 sessions = ['2024-02-02_H2_CL_5'] # all the sessions for which to plot the trajectories
 # sessions = ['2024-01-15_H1_CL_2'] # all the sessions for which to plot the trajectories
+rasterized = False # draw the trajectories as a bitmap inside the pdf, which keeps it small and fast to save
 
 def get_trials_indices(session):
     """ given a sesssion name, return task_data, the start and end of center-out trials"""
     task_data = data_util.load_data(f'/data/raspy/{session}/task.bin')
     # print(np.unique(task_data['state_task'], return_counts=True)) # 99 is for center target, 0: left, 1: right, 2: up, 3: down, 5: leftup, 6: leftdown, 7: rightup, 8:rightdown)
-    trial_start_inds = np.nonzero((task_data['state_task'][0:-1] == 99)*(task_data['state_task'][1:None] != 99))[0] + 1
-    trial_end_inds = np.nonzero((task_data['state_task'][0:-1] != 99)*(task_data['state_task'][1:None] == 99))[0] + 1 # last index containing the same state_task
-    if trial_start_inds[0] < trial_end_inds[0]:
-        trial_start_inds = trial_start_inds[0:len(trial_end_inds)] # only use trials that end.
-    else:
-        # For when there's an end before a start. Not sure why this happens.
-        trial_end_inds = trial_end_inds[1:None]
-        trial_start_inds = trial_start_inds[0:len(trial_end_inds)] # only use trials that end.
+    trial_start_inds, trial_end_inds = trial_util.get_center_out_trial_inds(task_data['state_task'])
     return task_data, trial_start_inds, trial_end_inds
 
 # Define colors for 8 targets
@@ -44,13 +41,12 @@ axes = axes.flatten()
 for session in sessions:
     task_data, trial_start_inds, trial_end_inds = get_trials_indices(session)
     print(len(trial_start_inds), len(trial_end_inds))
-    for trial_no, (start, end) in enumerate(zip(trial_start_inds, trial_end_inds)):
-        xy = task_data['decoded_pos'][start:end]
-        target_no = int(task_data['state_task'][start].item())
-        if target_no > 3:
-            target_no -= 1
-        ax = axes[target_no]
-        ax.plot(xy[:, 0], xy[:, 1], color = colors[target_no])
+    target_nos = task_data['state_task'].flatten()[trial_start_inds].astype('int')
+    target_nos = target_nos - (target_nos > 3)
+    paths = trial_util.trial_paths(task_data['decoded_pos'], trial_start_inds, trial_end_inds)
+    for target_no, ax in enumerate(axes):
+        # one collection per target instead of one line per trial
+        add_trajectories(ax, [paths[i] for i in np.nonzero(target_nos == target_no)[0]], colors[target_no], rasterized=rasterized)
         # print('Hello')
         # circle = plt.Circle(positions[target_no], 0.39/2, color=colors[target_no], alpha=0.1)
         # ax.add_patch(circle)
@@ -60,8 +56,8 @@ for session in sessions:
         ax.set_ylim(-1.1, 1.1)
         ax.set_aspect('equal')
         ax.axis('off')
-        plt.tight_layout()
-        # print(f"Session: {session}, Trial: {trial_no}, Target: {target_no}, Data Shape: {xy.shape}")
+    plt.tight_layout()
+    # print(f"Session: {session}, Trial: {trial_no}, Target: {target_no}, Data Shape: {xy.shape}")
 # target_nos = task_data['state_task'][trial_start_inds]
 # for target_no, ax in enumerate(axes):
 #     if target_no > 3:
@@ -0,0 +1,321 @@
+import numpy as np
+import data_util
+import synthetic_session
+import argparse
+import json
+import multiprocessing
+import os
+import pathlib
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+def legacy_downsample_data(data, keys, downsample=1, start=0, end=None):
+    """ downsample_data as it was before the fields were filled by vectorized assignment """
+    dtype = []
+    for key in keys:
+        dtype.append((key, data[key].dtype.str, data[key][0].shape))
+    return np.array(list(zip(*[data[key][start:end:downsample] for key in keys])), dtype=dtype)
+
+def legacy_resave_data(data, path, name='', labels=None):
+    """ resave_data as it was before the fields were filled by vectorized assignment """
+    if labels is None:
+        labels = data['labels']
+    dtypes = [(label, data[label].dtype.str, data[label][0].shape) for label in labels]
+    dtypes_str = ','.join([dt[1] for dt in dtypes]) + '$' + ','.join([str(dt[2]) for dt in dtypes])
+    header = name + '\n' + ','.join(labels) + '\n' + dtypes_str + '\n'
+    data = np.array(list(zip(*[data[label] for label in labels])), dtype=dtypes)
+    with open(path, 'wb') as f:
+        f.write(header.encode('utf-8'))
+        f.write(data.tobytes())
+
+def make_session(session_dir, rows, channels, fs=1000.0):
+    """ writes a synthetic session of about rows eeg samples into session_dir with synthetic_session.write_session and
+    returns its eeg.bin as read by data_util.load_data (a structured array) """
+    synthetic_session.write_session(session_dir, duration=rows/fs, channels=channels, fs=fs)
+    return data_util.load_data(pathlib.Path(session_dir) / 'eeg.bin', return_dict=False)
+
+def _as_dict(data):
+    return {'name': 'eeg', 'labels': list(data.dtype.names), 'dtypes': [], **{label: data[label] for label in data.dtype.names}}
+
+def _import_scipy(data, path):
+    import scipy.signal # imported lazily by data_util, so not part of the timing
+
+# name -> case(data, path): data is the eeg.bin of the synthetic session, path the file to write in its folder
+CASES = {
+    'load_data': lambda data, path: data_util.load_data(path.parent / 'eeg.bin'),
+    'load_data mmap eeg': lambda data, path: np.asarray(data_util.load_data(path.parent / 'eeg.bin', labels=['eeg'], mmap=True)['eeg']).sum(),
+    'downsample_data legacy': lambda data, path: legacy_downsample_data(data, data.dtype.names, downsample=2),
+    'downsample_data': lambda data, path: data_util.downsample_data(data, keys=None, downsample=2, return_dict=False),
+    # reordered keys: the fields are filled one by one instead of returning a view of the rows
+    'downsample_data reordered legacy': lambda data, path: legacy_downsample_data(data, data.dtype.names[::-1], downsample=2),
+    'downsample_data reordered': lambda data, path: data_util.downsample_data(data, keys=data.dtype.names[::-1], downsample=2,
+                                                                              return_dict=False),
+    'resave_data legacy': lambda data, path: legacy_resave_data(_as_dict(data), path, 'eeg'),
+    'resave_data': lambda data, path: data_util.resave_data(_as_dict(data), path, 'eeg'),
+    'DataFilter.filter_data': lambda data, path: data_util.DataFilter(fn=[60.0], q=[30.0], fc=[1.0, 40.0], btype='bandpass',
+                                                                      order=2).filter_data(data['eeg']),
+    'DataFilter.filter_data single': lambda data, path: data_util.DataFilter(fn=[60.0], q=[30.0], fc=[1.0, 40.0], btype='bandpass',
+                                                                             order=2, precision='single').filter_data(data['eeg']),
+    'Decimator.decimate': lambda data, path: data_util.Decimator(4).decimate(data['eeg']),
+    'RunningStats.update': lambda data, path: data_util.RunningStats().update(data['eeg']),
+    'sliding_dft': lambda data, path: data_util.sliding_dft(data['eeg'], 256, 16, downsample=16),
+    'sliding_dft single': lambda data, path: data_util.sliding_dft(data['eeg'], 256, 16, downsample=16, precision='single'),
+    'sliding_z': lambda data, path: data_util.sliding_z(data['eeg'], 256, 0.99*np.exp(2j*np.pi*np.arange(16)/256), downsample=16),
+    'sliding_z single': lambda data, path: data_util.sliding_z(data['eeg'], 256, 0.99*np.exp(2j*np.pi*np.arange(16)/256), downsample=16,
+                                                               precision='single'),
+    'epoch_power': lambda data, path: data_util.epoch_power(data['eeg'], np.arange(1000, len(data)-3000, 4000), 500, np.arange(4, 16),
+                                                            before=1000, after=3000, step=50),
+    'subsequences': lambda data, path: np.array(data_util.subsequences(data['eeg'], np.arange(1000, len(data), 100), width=500)),
+}
+SETUP = {
+    # runs before the timed case
+    'DataFilter.filter_data': _import_scipy,
+    'DataFilter.filter_data single': _import_scipy,
+    'Decimator.decimate': _import_scipy,
+    'epoch_power': _import_scipy,
+}
+
+# largest error of the sliding transform methods (in double precision) relative to the largest magnitude of the reference
+EQUIVALENCE_BOUND = 1e-9
+
+def _sliding_transforms(N):
+    # name -> transform(x, method) of sliding_dft and of sliding_z on and inside the unit circle
+    bins = np.arange(4, 16)
+    transforms = {'sliding_dft': lambda x, method: data_util.sliding_dft(x, N, bins, downsample=4, dtype='complex128', method=method,
+                                                                          precision='double')}
+    # with few channels and bins the chunks are long, so damped zs test that the phases of a chunk stay bounded
+    for r, z_bins in ((0.99, bins), (0.9, bins), (0.9, bins[0:2])):
+        zs = r*np.exp(2j*np.pi*z_bins/N)
+        transforms[f'sliding_z |z|={r} {len(z_bins)} bins'] = lambda x, method, zs=zs: data_util.sliding_z(x, N, zs, downsample=4, dtype='complex128',
+                                                                                                         method=method, precision='double')
+    return transforms
+
+def equivalence_errors(rows, N=256, short_rows=20000):
+    """ errors of the methods of the sliding transforms against each other, on float32 and float64 data with 1 and 8
+    channels: against the per-sample recurrence over short_rows samples, and of chunked against matmul over rows
+    samples of float32 data (where errors carried by the state would grow). dict of name -> error """
+    rng = np.random.default_rng(0)
+    errors = {}
+    for name, transform in _sliding_transforms(N).items():
+        methods = ['chunked', 'matmul', 'fft'] if name == 'sliding_dft' else ['chunked', 'matmul']
+        for dtype in ('float32', 'float64'):
+            for channels in (1, 8):
+                x = rng.standard_normal((short_rows, channels)).astype(dtype)
+                reference = transform(x, 'recurrence')
+                for method in methods:
+                    errors[f'{name} {method} vs recurrence {dtype} D={channels}'] = (np.max(np.abs(transform(x, method) - reference))
+                                                                                     /np.max(np.abs(reference)))
+        x = rng.standard_normal((rows, 1)).astype('float32')
+        reference = transform(x, 'matmul')
+        errors[f'{name} chunked vs matmul float32 L={rows}'] = np.max(np.abs(transform(x, 'chunked') - reference))/np.max(np.abs(reference))
+    return errors
+
+# largest error of the single precision path relative to the double path, as documented at data_util.PRECISION:
+# for the filters relative to every output value, for the sliding transforms relative to the largest magnitude
+PRECISION_BOUNDS = {
+    'DataFilter bandpass 1-40 Hz + notch': 2.0**-24,
+    'DataFilter highpass 0.5 Hz': 2.0**-24,
+    'sliding_dft chunked': 2e-5,
+    'sliding_dft matmul': 5e-5,
+    'sliding_dft fft': 1e-6,
+    'sliding_z chunked': 2e-5,
+    'sliding_z matmul': 5e-5,
+    'sliding_z |z|=0.9 D=1 2 bins chunked': 2e-5, # long chunks, damped zs
+    'sliding_z |z|=0.9 D=1 2 bins matmul': 5e-5,
+}
+
+def precision_errors(rows, channels):
+    """ errors of the single precision path relative to the double path of data_util, on a recording with a 10 Hz
+    rhythm, 60 Hz line noise, a large offset and a slow drift (the worst case for float32). dict of name -> error """
+    rng = np.random.default_rng(0)
+    t = np.arange(rows)/1000.0
+    x = (10*rng.standard_normal((rows, channels)) + 30*np.sin(2*np.pi*10*t)[:, None] + 20*np.sin(2*np.pi*60*t)[:, None]
+         + 500 + 0.01*np.arange(rows)[:, None]).astype('float32')
+    errors = {}
+    filters = {'DataFilter bandpass 1-40 Hz + notch': dict(fn=[60.0], q=[30.0], fc=[1.0, 40.0], btype='bandpass', order=2),
+               'DataFilter highpass 0.5 Hz': dict(fc=0.5, btype='highpass', order=2)}
+    for name, kwargs in filters.items():
+        double = data_util.DataFilter(**kwargs, precision='double').filter_data(x)
+        single = data_util.DataFilter(**kwargs, precision='single').filter_data(x)
+        errors[name] = np.max(np.abs(single - double)/np.maximum(np.abs(double), np.finfo('float32').tiny))
+    zs = 0.995*np.exp(2j*np.pi*np.arange(4, 16)/256)
+    damped_zs = 0.9*np.exp(2j*np.pi*np.array([10, 20])/512)
+    for method in ('chunked', 'matmul', 'fft'):
+        transforms = {'sliding_dft': lambda precision, dtype: data_util.sliding_dft(x, 256, np.arange(4, 16), downsample=16, method=method,
+                                                                                    dtype=dtype, precision=precision)}
+        if method != 'fft':
+            transforms['sliding_z'] = lambda precision, dtype: data_util.sliding_z(x, 256, zs, downsample=16, method=method,
+                                                                                   dtype=dtype, precision=precision)
+            transforms['sliding_z |z|=0.9 D=1 2 bins'] = lambda precision, dtype: data_util.sliding_z(x[:, 0:1], 512, damped_zs, downsample=16,
+                                                                                                    method=method, dtype=dtype, precision=precision)
+        for name, transform in transforms.items():
+            double = transform('double', 'complex128')
+            single = transform('single', 'complex64')
+            errors[f'{name} {method}'] = np.max(np.abs(single - double))/np.max(np.abs(double))
+    return errors
+
+def _maxrss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+
+def _rss_mb():
+    # current resident set size, from the second field of /proc/self/statm (in pages)
+    with open('/proc/self/statm', 'r') as f:
+        return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/2.0**20
+
+class PeakRSS():
+    """ peak resident set size while the block runs, sampled from /proc/self/statm every interval s in a thread. when the
+    block raises the high-water mark of the process (ru_maxrss) that is the exact peak, otherwise the largest sample """
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.peak_mb = np.nan
+        return
+    def _sample(self):
+        while not self.done.wait(self.interval):
+            self.peak_mb = max(self.peak_mb, _rss_mb())
+    def __enter__(self):
+        self.maxrss0 = _maxrss_mb()
+        self.peak_mb = _rss_mb()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        return self
+    def __exit__(self, *exc):
+        self.done.set()
+        self.thread.join()
+        self.peak_mb = max(self.peak_mb, _rss_mb())
+        maxrss = _maxrss_mb()
+        if maxrss > self.maxrss0:
+            self.peak_mb = max(self.peak_mb, maxrss)
+        return False
+
+def _run_case(name, rows, channels, queue):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        data = make_session(pathlib.Path(tmpdir) / 'session', rows, channels)
+        path = pathlib.Path(tmpdir) / 'session' / 'out.bin'
+        if name in SETUP:
+            SETUP[name](data, path)
+        rss0 = _rss_mb() # after the setup, so only the memory of the case is counted
+        with PeakRSS() as peak:
+            t0 = time.perf_counter()
+            CASES[name](data, path)
+            elapsed = time.perf_counter() - t0
+        queue.put({'rows_per_sec': len(data)/elapsed, 'peak_rss_mb': peak.peak_mb - rss0, 'seconds': elapsed})
+
+def run_case(name, rows, channels):
+    """ runs one case in a fresh process so that its peak RSS is not polluted by the other cases """
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=_run_case, args=(name, rows, channels, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+IMPORT_MODULES = ['data_util', 'plot_util', 'trial_util', 'plot_singlesession_trajectories', 'plot_twosessions_path_efficiency']
+
+def run_scaling(names, sizes, channels):
+    """ results of every case at every number of rows, as a list of dicts with keys case, rows, channels,
+    rows_per_sec, peak_rss_mb and seconds """
+    results = []
+    for name in names:
+        for rows in sizes:
+            results.append({'case': name, 'rows': rows, 'channels': channels, **run_case(name, rows, channels)})
+    return results
+
+def compare(results, baseline, tolerance=0.8):
+    """ the results whose throughput fell below tolerance times the throughput of the same case and size in baseline,
+    as (result, baseline result) pairs """
+    reference = {(r['case'], r['rows'], r['channels']): r for r in baseline}
+    regressions = []
+    for r in results:
+        old = reference.get((r['case'], r['rows'], r['channels']))
+        if old is not None and r['rows_per_sec'] < tolerance*old['rows_per_sec']:
+            regressions.append((r, old))
+    return regressions
+
+def import_time_ms(module):
+    """ cumulative import time of module in a fresh interpreter, from python -X importtime """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1])/1000.0
+    raise RuntimeError(f'no import time reported for {module}')
+
+def import_modules(module):
+    """ names of the modules imported by importing module in a fresh interpreter """
+    result = subprocess.run([sys.executable, '-c', f'import sys, {module}; print(" ".join(sys.modules))'], capture_output=True,
+                            text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    return result.stdout.split()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000, help='number of eeg samples in the synthetic session')
+    parser.add_argument('--channels', type=int, default=64, help='number of eeg channels')
+    parser.add_argument('--sizes', type=int, nargs='+', default=None, help='numbers of rows to run every case at, for scaling curves (default: --rows)')
+    parser.add_argument('--cases', nargs='+', default=None, help='cases to run (default: all)')
+    parser.add_argument('--json', default=None, help='save the results to this json file')
+    parser.add_argument('--compare', default=None, help='json file of an earlier run. exits with 1 if a case got slower')
+    parser.add_argument('--tolerance', type=float, default=0.8, help='with --compare, fraction of the earlier throughput that is still accepted')
+    parser.add_argument('--imports', action='store_true', help='benchmark the import time of the modules instead')
+    parser.add_argument('--equivalence', action='store_true',
+                        help='check that the methods of the sliding transforms agree instead. exits with 1 if one differs by more than EQUIVALENCE_BOUND')
+    parser.add_argument('--precision', action='store_true',
+                        help='check the errors of the single precision path against their documented bounds instead. exits with 1 if one is exceeded')
+    parser.add_argument('--max-import-ms', type=float, default=None,
+                        help='with --imports, fail if a module takes longer to import or pulls in torch, pyplot or scipy.signal/linalg')
+    args = parser.parse_args()
+
+    if args.imports:
+        failed = False
+        print(f'{"module":<36}{"import (ms)":>12}  heavy modules')
+        for module in IMPORT_MODULES:
+            ms = min(import_time_ms(module) for i in range(3))
+            heavy = sorted(name for name in import_modules(module) if name in ('torch', 'matplotlib.pyplot', 'scipy.signal', 'scipy.linalg'))
+            print(f'{module:<36}{ms:>12.1f}  {" ".join(heavy)}')
+            if args.max_import_ms is not None and (ms > args.max_import_ms or len(heavy) > 0):
+                failed = True
+        sys.exit(1 if failed else 0)
+
+    if args.equivalence:
+        errors = equivalence_errors(args.rows)
+        print(f'{"case":<64}{"error":>12}')
+        for name, error in errors.items():
+            print(f'{name:<64}{error:>12.3g}{"" if error <= EQUIVALENCE_BOUND else "  exceeded"}')
+        sys.exit(1 if any(not error <= EQUIVALENCE_BOUND for error in errors.values()) else 0)
+
+    if args.precision:
+        errors = precision_errors(args.rows, min(args.channels, 8))
+        print(f'{"case":<44}{"error":>12}{"bound":>12}')
+        for name, error in errors.items():
+            print(f'{name:<44}{error:>12.3g}{PRECISION_BOUNDS[name]:>12.3g}{"" if error <= PRECISION_BOUNDS[name] else "  exceeded"}')
+        sys.exit(1 if any(not error <= PRECISION_BOUNDS[name] for name, error in errors.items()) else 0)
+
+    names = list(CASES) if args.cases is None else args.cases
+    for name in names:
+        if name not in CASES:
+            raise ValueError(f'unknown case {name!r}, choose from {list(CASES)}')
+    sizes = args.sizes if args.sizes is not None else [args.rows]
+    results = run_scaling(names, sizes, args.channels)
+    print(f'{"case":<36}{"rows":>10}{"rows/sec":>14}{"peak RSS (MB)":>16}')
+    for result in results:
+        print(f'{result["case"]:<36}{result["rows"]:>10}{result["rows_per_sec"]:>14.3g}{result["peak_rss_mb"]:>16.1f}')
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'python': sys.version, 'numpy': np.__version__, 'results': results}, f, indent=1)
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for result, old in regressions:
+            print(f'regression: {result["case"]} at {result["rows"]} rows, {result["rows_per_sec"]:.3g} rows/sec '
+                  f'vs {old["rows_per_sec"]:.3g}')
+        sys.exit(1 if len(regressions) > 0 else 0)
@@ -1,46 +1,152 @@
+import os
+import sys
 import numpy as np
-import torch
-import torch.nn as nn
-import scipy
-import scipy.signal
 import ast
+import bisect
+import json
+import struct
+import zlib
+import topology
+import profiling
 
-def load_data(filename, return_dict=True, copy_arr=False):
+from topology import electrode_names, inds_original, GRIDSHAPE
+
+# precision of DataFilter, FilterBank, sliding_dft and sliding_z when they are given precision=None: 'double'
+# (float64/complex128) or 'single' (float32/complex64, half the memory traffic). In single precision
+# - the filters return float32. their recursion still runs in float64, block by block, so the only error is the
+#   rounding of the output, below 2**-24 of every value
+# - the sliding transforms do all their math in complex64. errors relative to the largest output magnitude stay
+#   below 2e-5 for chunked, 5e-5 for matmul and 1e-6 for fft, measured on 1e6 samples of a 10 Hz rhythm (amplitude 30)
+#   on an offset of 500 drifting to 1e4, for sliding_dft and sliding_z at |zs| = 0.995 (N=256, 8 channels, 12 bins)
+#   and |zs| = 0.9 (N=512, 1 channel, 2 bins). The bounds depend on
+#   - L: the state carried by chunked accumulates rounding, growing about as sqrt(L/P) for chunks of P samples
+#     (2e-6 to 1e-5 at L=1e6, so the bound holds to about L=1e7)
+#   - the offset and drift relative to the output magnitude: matmul and fft sum N products of the raw samples,
+#     remove large offsets first for tighter bounds
+#   - |zs|: sliding_z grows as |zs|**(-N), which must stay far below the float32 maximum of 3e38. chunks are
+#     capped (_chunk_size) so that the phases within one stay bounded for any |zs|
+# benchmark_data_util.py --precision checks these bounds against the double path.
+PRECISION = 'double'
+_PRECISION_DTYPES = {'single': (np.dtype('float32'), np.dtype('complex64')), 'double': (np.dtype('float64'), np.dtype('complex128'))}
+
+def precision_dtypes(precision=None):
+    # real and complex dtypes of precision 'single' or 'double' (None: PRECISION)
+    if precision is None:
+        precision = PRECISION
+    if precision not in _PRECISION_DTYPES:
+        raise ValueError('precision must be single or double')
+    return _PRECISION_DTYPES[precision]
+
+def read_header(filename):
+    # parses the three-line text header (name, labels, dtypes[$shapes]) of a .bin file.
+    # returns name, labels, dtypes, the structured dtype of one record and the byte offset of the payload.
     with open(filename, 'rb') as openfile:
         name = openfile.readline().decode('utf-8').strip()
         labels = openfile.readline().decode('utf-8').strip()
         dtypes = openfile.readline().decode('utf-8').strip()
-        shapes = None
-        # shapes can be indicated with a $ to separate.
-        if len(dtypes.split('$')) == 2:
-            dtypes, shapes = dtypes.split('$')
-            dtypes = dtypes.strip()
-            shapes = ast.literal_eval(shapes.strip())
-        
-        labels = labels.split(',')
-        dtypes = dtypes.split(',')
-        if shapes is None:
-            data = np.fromfile(openfile, dtype=[item for item in zip(labels, dtypes)])
-        else:
-            data = np.fromfile(openfile, dtype=[item for item in zip(labels, dtypes, shapes)])
-        if not return_dict:
-            return data
-        if copy_arr:
-            # copy separates the individual arrays from the bulk numpy array, allowing for memory consolidation.
-            data_dict = {label: data[label].copy() for label in labels}
+        offset = openfile.tell()
+    shapes = None
+    # shapes can be indicated with a $ to separate.
+    if len(dtypes.split('$')) == 2:
+        dtypes, shapes = dtypes.split('$')
+        dtypes = dtypes.strip()
+        shapes = ast.literal_eval(shapes.strip())
+
+    labels = labels.split(',')
+    dtypes = dtypes.split(',')
+    if shapes is None:
+        dtype = np.dtype([item for item in zip(labels, dtypes)])
+    else:
+        dtype = np.dtype([item for item in zip(labels, dtypes, shapes)])
+    return name, labels, dtypes, dtype, offset
+
+def _map_records(filename, dtype, offset):
+    nrows = (os.path.getsize(filename) - offset)//dtype.itemsize
+    if nrows > 0:
+        return np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(nrows,))
+    return np.zeros(0, dtype=dtype) # np.memmap cannot map an empty payload
+
+def time_range_rows(records, time_label, tmin=None, tmax=None):
+    # row range [start, end) of the records with tmin <= time < tmax, for a non-decreasing time_label.
+    # binary search, so only about log2(len(records)) records are read from a memory-mapped file.
+    times = records[time_label]
+    if times.ndim > 1:
+        times = times.reshape((len(times), -1))[:, 0]
+    start = 0 if tmin is None else bisect.bisect_left(times, tmin)
+    end = len(times) if tmax is None else bisect.bisect_left(times, tmax)
+    return start, end
+
+@profiling.traced('data_util.load_data')
+def load_data(filename, return_dict=True, copy_arr=False, labels=None, mmap=False, start=None, end=None,
+              time_label=None, tmin=None, tmax=None):
+    # labels: list of labels to put in the returned dict. None uses all the labels in the file.
+    # mmap: memory-map the payload instead of reading it. The per-label arrays are then zero-copy views
+    #   into the file and pages are only read from disk when they are used.
+    # copy_arr: copy the (requested) per-label arrays out of the bulk array. With mmap=True only the
+    #   requested labels are read, and the file mapping is released.
+    # start, end: only read the rows [start, end) (numpy slice semantics). The reader seeks straight to them.
+    # time_label, tmin, tmax: only read the rows with tmin <= time < tmax (either can be None) for a
+    #   non-decreasing time_label, e.g. a timestamp. The rows are found by binary search in the file.
+    name, all_labels, all_dtypes, dtype, offset = read_header(filename)
+    if mmap or time_label is not None or start is not None or end is not None:
+        data = _map_records(filename, dtype, offset)
+        if time_label is not None:
+            start, end = time_range_rows(data, time_label, tmin, tmax)
+        start, end, step = slice(start, end).indices(len(data))
+        end = max(start, end)
+        if not mmap:
+            with open(filename, 'rb') as openfile:
+                openfile.seek(offset + start*dtype.itemsize)
+                data = np.fromfile(openfile, dtype=dtype, count=end-start)
         else:
-            data_dict = {label: data[label] for label in labels}
-        data_dict['name'] = name
-        data_dict['labels'] = labels
-        data_dict['dtypes'] = dtypes
+            data = data[start:end]
+    else:
+        with open(filename, 'rb') as openfile:
+            openfile.seek(offset)
+            data = np.fromfile(openfile, dtype=dtype)
+    if not return_dict:
+        return data
+    if labels is None:
+        labels = all_labels
+    else:
+        labels = list(labels)
+        for label in labels:
+            if label not in all_labels:
+                raise ValueError('label {} not in {}'.format(label, filename))
+    if copy_arr:
+        # copy separates the individual arrays from the bulk numpy array, allowing for memory consolidation.
+        data_dict = {label: np.array(data[label]) for label in labels}
+    else:
+        data_dict = {label: data[label] for label in labels}
+    data_dict['name'] = name
+    data_dict['labels'] = labels
+    data_dict['dtypes'] = [all_dtypes[all_labels.index(label)] for label in labels]
     return data_dict
 
-def downsample_data(data, keys=[], downsample=1, start=0, end=None, return_dict=True, name=''):
+def _pack_fields(data, labels, dtype, index=slice(None)):
+    # builds a packed structured array with fields labels from data (dict or structured array), taking
+    # rows index of each. Fields are filled by vectorized assignment instead of building per-row tuples.
+    if not isinstance(data, dict) and tuple(labels) == data.dtype.names and np.dtype(dtype) == data.dtype:
+        # no reorder or type change needed: a (strided) view of the rows
+        return data[index]
+    n = len(range(*index.indices(len(data[labels[0]])))) if len(labels) > 0 else 0
+    out = np.empty(n, dtype=dtype)
+    for label in labels:
+        out[label] = data[label][index]
+    return out
+
+@profiling.traced('data_util.downsample_data')
+def downsample_data(data, keys=[], downsample=1, start=0, end=None, return_dict=True, name='', copy=True, antialias=None):
     # keys is a list of keys to downsample and return. None will use all the keys
     # downsample will only keep every {downsample} entries. 1 keeps all.
     # start: index of first entry
     # end: numpy slice end index
     # name: name to assign to out_dict['name'] if this is a dict
+    # copy: if False and return_dict, the returned arrays are strided views into data instead of fields of a
+    #   new packed array.
+    # antialias: keys to lowpass filter (Decimator, FIR) before decimating, e.g. the eeg. The other keys keep
+    #   every {downsample} entries, aligned with the filtered ones. None only takes every {downsample} entries,
+    #   which aliases frequencies above the new nyquist frequency.
     if keys is None:
         if isinstance(data, dict):
             keys = data['labels']
@@ -49,13 +155,24 @@ def downsample_data(data, keys=[], downsample=1, start=0, end=None, return_dict=
     
     dtype = []
     for key in keys:
-        dtype.append((key, data[key].dtype.str, data[key][0].shape))
-    out = np.array(list(zip(*[data[key][start:end:downsample] for key in keys])), dtype=dtype)
-    if not return_dict:
-        return out
-    out_dict = {key: out[key] for key in keys}
+        dtype.append((key, data[key].dtype.str, data[key].shape[1:None]))
+    index = slice(start, end, downsample)
+    if antialias and downsample > 1:
+        decimator = Decimator(downsample)
+        if name is None and isinstance(data, dict) and 'name' in data:
+            name = data['name']
+        data = {key: decimator.decimate(data[key][start:end]).astype(data[key].dtype) if key in antialias else data[key][index]
+                for key in keys}
+        index = slice(None)
+    if return_dict and not copy:
+        out_dict = {key: data[key][index] for key in keys}
+    else:
+        out = _pack_fields(data, keys, dtype, index)
+        if not return_dict:
+            return out
+        out_dict = {key: out[key] for key in keys}
     if name is None:
-        if isinstance(data, dict) and name in data:
+        if isinstance(data, dict) and 'name' in data:
             name = data['name']
         else:
             name = ''
@@ -64,6 +181,25 @@ def downsample_data(data, keys=[], downsample=1, start=0, end=None, return_dict=
     out_dict['dtypes'] = [dt[1] for dt in dtype]
     return out_dict
 
+def atomic_write(path, write, mode='wb'):
+    """ writes a file by calling write(f) on a temporary file next to path, which then replaces path in one rename.
+    concurrent readers see the old or the new file and a crash never leaves a partial one. creates the parent folder """
+    path = os.fspath(path)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, mode) as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return
+
+@profiling.traced('data_util.resave_data')
 def resave_data(data, path, name='', labels=None, as_npy=False):
     # name is the name of this data, and goes in the first line of the file.
     # labels is the names of the variables to keep
@@ -76,7 +212,7 @@ def resave_data(data, path, name='', labels=None, as_npy=False):
     if isinstance(data, dict):
         if labels is None:
             labels = data['labels']
-        dtypes = [(label, data[label].dtype.str, data[label][0].shape) for label in labels]
+        dtypes = [(label, data[label].dtype.str, data[label].shape[1:None]) for label in labels]
         dtypes_str = ','.join([dt[1] for dt in dtypes]) + '$' + ','.join([str(dt[2]) for dt in dtypes])
     else:
         if labels is None:
@@ -84,7 +220,7 @@ def resave_data(data, path, name='', labels=None, as_npy=False):
             dtypes = data.dtype
             dtypes_str = ','.join([data.dtype[i].base.str for i in range(len(data.dtype))]) + '$' + ','.join([str(data.dtype[i].shape) for i in range(len(data.dtype))])
         else:
-            dtypes = [(label, data[label].dtype.str, data[label][0].shape) for label in labels]
+            dtypes = [(label, data[label].dtype.str, data[label].shape[1:None]) for label in labels]
             dtypes_str = ','.join([dt[1] for dt in dtypes]) + '$' + ','.join([str(dt[2]) for dt in dtypes])
 
     header += ','.join(labels) + '\n'
@@ -93,25 +229,177 @@ def resave_data(data, path, name='', labels=None, as_npy=False):
 
 
     if not labels_was_none or isinstance(data, dict):
-        vs = list(zip(*[data[label] for label in labels]))
-        data = np.array(vs, dtype=dtypes)
+        data = _pack_fields(data, labels, dtypes)
     
     if as_npy:
         np.save(path, data)
     else:
         with open(path, 'wb') as f:
             f.write(header.encode(encoding))
-            f.write(data.tobytes())
+            # tofile writes straight from the array (or the rows of a strided view) without a bytes copy
+            data.tofile(f)
+    return
+
+# torch and scipy are slow to import, so they are only imported by the code that needs them.
+# data can only be a torch Tensor if torch has already been imported by the caller.
+def _is_tensor(data):
+    torch = sys.modules.get('torch')
+    return torch is not None and isinstance(data, torch.Tensor)
+
+COLUMNAR_MAGIC = b'BCICOL1\n'
+
+def _compressor(compression):
+    # returns (compression name actually used, compress function, decompress function)
+    if compression is None or compression == 'none':
+        return 'none', bytes, bytes
+    if compression == 'lz4':
+        try:
+            import lz4.frame
+            return 'lz4', lz4.frame.compress, lz4.frame.decompress
+        except ImportError:
+            compression = 'zlib' # pure-stdlib fallback
+    if compression == 'zlib':
+        return 'zlib', lambda b: zlib.compress(b, 1), zlib.decompress
+    raise ValueError('compression must be None, zlib or lz4')
+
+def _chunk_limits(arr):
+    # min and max of a chunk, for the chunk index. None for non-numeric or empty data.
+    if arr.size == 0 or not (np.issubdtype(arr.dtype, np.number) or np.issubdtype(arr.dtype, np.bool_)):
+        return None, None
+    return np.min(arr).item(), np.max(arr).item()
+
+@profiling.traced('data_util.write_columnar')
+def write_columnar(data, path, name='', labels=None, chunk_rows=65536, compression='zlib'):
+    # saves data (dict from load_data or a structured array) in the columnar format: every label is stored
+    # in chunks of chunk_rows rows, each chunk contiguous and optionally compressed ('zlib', 'lz4' or None),
+    # followed by a json index with the offset, size and min/max of every chunk.
+    # data can also be an iterable of structured arrays (e.g. chunks of a memory-mapped file), which are
+    # written one at a time; each then becomes a chunk of every label.
+    if isinstance(data, dict):
+        if labels is None:
+            labels = data['labels']
+        if name == '' and 'name' in data:
+            name = data['name']
+        parts = (_pack_fields(data, labels, [(label, data[label].dtype.str, data[label].shape[1:None]) for label in labels],
+                              slice(start, start+chunk_rows)) for start in range(0, max(len(data[labels[0]]), 1), chunk_rows))
+    elif isinstance(data, np.ndarray):
+        if labels is None:
+            labels = data.dtype.names
+        parts = (data[start:start+chunk_rows] for start in range(0, max(len(data), 1), chunk_rows))
+    else:
+        parts = data
+    compression, compress, decompress = _compressor(compression)
+    columns = None
+    nrows = 0
+    with open(path, 'wb') as f:
+        f.write(COLUMNAR_MAGIC)
+        for part in parts:
+            if columns is None:
+                if labels is None:
+                    labels = part.dtype.names
+                labels = list(labels)
+                columns = {label: [] for label in labels}
+                dtypes = [part[label].dtype.str for label in labels]
+                shapes = [list(part[label].shape[1:None]) for label in labels]
+            for label in labels:
+                arr = np.ascontiguousarray(part[label])
+                raw = compress(arr.tobytes())
+                columns[label].append([f.tell(), len(raw), len(arr), *_chunk_limits(arr)])
+                f.write(raw)
+            nrows += len(part)
+        if columns is None:
+            raise ValueError('data has no chunks to write')
+        index = {'name': name, 'labels': labels, 'dtypes': dtypes, 'shapes': shapes, 'nrows': nrows,
+                 'compression': compression, 'columns': columns}
+        index_offset = f.tell()
+        f.write(json.dumps(index).encode('utf-8'))
+        f.write(struct.pack('<Q', index_offset))
+        f.write(COLUMNAR_MAGIC)
+    return
+
+def read_columnar_index(path):
+    # reads the json index at the end of a columnar file
+    with open(path, 'rb') as f:
+        if f.read(len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+            raise ValueError('{} is not a columnar file'.format(path))
+        f.seek(-8-len(COLUMNAR_MAGIC), os.SEEK_END)
+        index_offset, = struct.unpack('<Q', f.read(8))
+        index_end = f.tell() - 8
+        f.seek(index_offset)
+        return json.loads(f.read(index_end - index_offset).decode('utf-8'))
+
+def _read_column(f, index, label, start, end):
+    # reads rows [start, end) of one label, touching only the chunks that overlap them
+    compression, compress, decompress = _compressor(index['compression'])
+    i = index['labels'].index(label)
+    dtype = np.dtype(index['dtypes'][i])
+    shape = tuple(index['shapes'][i])
+    out = np.empty((end-start, *shape), dtype=dtype)
+    chunk_start = 0
+    for offset, nbytes, n, cmin, cmax in index['columns'][label]:
+        chunk_end = chunk_start + n
+        if chunk_end > start and chunk_start < end:
+            f.seek(offset)
+            chunk = np.frombuffer(decompress(f.read(nbytes)), dtype=dtype).reshape((n, *shape))
+            lo, hi = max(start, chunk_start), min(end, chunk_end)
+            out[lo-start:hi-start] = chunk[lo-chunk_start:hi-chunk_start]
+        chunk_start = chunk_end
+    return out
+
+def _time_range(f, index, time_label, tmin, tmax):
+    # row range [start, end) with tmin <= time < tmax for a non-decreasing time_label. The chunk max values
+    # locate the chunk of each bound, and only that chunk is read and binary searched.
+    chunks = index['columns'][time_label]
+    bounds = np.cumsum([0] + [chunk[2] for chunk in chunks])
+    def first_row(t):
+        # first row with time >= t
+        if t is None:
+            return 0
+        for i, (offset, nbytes, n, cmin, cmax) in enumerate(chunks):
+            if cmax is not None and cmax >= t:
+                times = _read_column(f, index, time_label, bounds[i], bounds[i+1]).reshape((n, -1))[:, 0]
+                return int(bounds[i] + np.searchsorted(times, t, side='left'))
+        return index['nrows']
+    return first_row(tmin), (index['nrows'] if tmax is None else first_row(tmax))
+
+@profiling.traced('data_util.read_columnar')
+def read_columnar(path, labels=None, start=0, end=None, time_label=None, tmin=None, tmax=None):
+    # reads labels (None for all) of a columnar file into a dict like load_data.
+    # start, end: row range [start, end) to read. With time_label, the rows with tmin <= time < tmax are read
+    #   instead; time_label must be non-decreasing. Only the chunks that overlap the rows are read.
+    index = read_columnar_index(path)
+    if labels is None:
+        labels = index['labels']
+    with open(path, 'rb') as f:
+        if time_label is not None:
+            start, end = _time_range(f, index, time_label, tmin, tmax)
+        start, end, step = slice(start, end).indices(index['nrows'])
+        end = max(start, end)
+        data_dict = {label: _read_column(f, index, label, start, end) for label in labels}
+    data_dict['name'] = index['name']
+    data_dict['labels'] = list(labels)
+    data_dict['dtypes'] = [index['dtypes'][index['labels'].index(label)] for label in labels]
+    return data_dict
+
+def convert_to_columnar(filename, path, chunk_rows=65536, compression='zlib'):
+    # converts a .bin file (header + interleaved records) to the columnar format in one pass over the
+    # memory-mapped records, chunk_rows rows at a time
+    name = read_header(filename)[0]
+    data = load_data(filename, return_dict=False, mmap=True)
+    parts = (data[start:start+chunk_rows] for start in range(0, max(len(data), 1), chunk_rows))
+    write_columnar(parts, path, name=name, compression=compression)
     return
 
 class DataFilter():
-    def __init__(self, fn=[], q=[], fc=None, btype='lowpass', order=1, fs=1000.0):
+    def __init__(self, fn=[], q=[], fc=None, btype='lowpass', order=1, fs=1000.0, precision=None):
+        import scipy.signal
         self.fn = fn # notch filter frequencies
         self.q = q # notch filter q factors
         self.fc = fc # butterworth filter cutoff frequencies (in Hz)
         self.btype = btype # 'lowpass', 'highpass', or 'bandpass'
         self.order = order # butterworth filter order, or orders if separate highpass (first) and lowpass (second) filters
         self.fs = fs # sampling frequency
+        self.dtypes = precision_dtypes(precision) # real and complex dtypes of the output
         
         self.sosnotch = [np.concatenate(scipy.signal.iirnotch(fn_i, q_i, fs=fs)).reshape((1, 6)) for fn_i, q_i in zip(fn, q)]
         if fc is None:
@@ -134,129 +422,552 @@ class DataFilter():
             raise ValueError('fc must match btype')
         
         self.zi0 = scipy.signal.sosfilt_zi(self.sos)
+        self.zi = None # filter state carried between chunks by process_chunk
         return
+    def initial_state(self, x0):
+        # steady-state filter state for a signal starting at sample x0 (scalar or (channels,))
+        if np.ndim(x0) == 0:
+            return self.zi0*x0
+        return self.zi0[..., None]@np.reshape(x0, (1, -1))
+    @profiling.traced('DataFilter.filter_data')
     def filter_data(self, data):
         # data should have shape (time, channels)
-        if data.ndim == 1:
-            zi = self.zi0*data[0]
-            out, zo = scipy.signal.sosfilt(self.sos, data, zi=zi)
+        out, zo = self._filter(data, self.initial_state(data[0]))
+        return out
+    def _filter(self, data, zi):
+        # filters blocks of about 2**16 values, each converted to float64 on its own. the recursion and its state stay
+        # in float64 (in float32, rounding of the state is amplified by the poles near the unit circle, up to 1e-1 of
+        # the rms for cutoffs near 1 Hz) while the data and the output keep their narrower dtypes, and the blocks
+        # stay in cache.
+        import scipy.signal
+        data = np.asarray(data)
+        complex_data = np.iscomplexobj(data)
+        out = np.empty(data.shape, dtype=self.dtypes[1] if complex_data else self.dtypes[0])
+        zi = np.asarray(zi, dtype='complex128' if complex_data else 'float64')
+        rows = max(1, 2**16//max(int(np.prod(data.shape[1:None])), 1))
+        for i in range(0, len(data), rows):
+            block = np.asarray(data[i:i+rows], dtype=zi.dtype)
+            out[i:i+rows], zi = scipy.signal.sosfilt(self.sos, block, axis=0, zi=zi)
+        return out, zi
+    def reset(self):
+        # forget the streaming state, so that the next chunk starts a new stream
+        self.zi = None
+    def process_chunk(self, chunk):
+        # filters the next chunk (time, channels) of a stream, carrying the filter state between calls.
+        # the state is initialized from the first sample of the first chunk, so the concatenated output is
+        # identical to filter_data on the concatenated input.
+        if len(chunk) == 0:
+            return np.zeros(chunk.shape, dtype=self.dtypes[0])
+        if self.zi is None:
+            self.zi = self.initial_state(chunk[0])
+        out, self.zi = self._filter(chunk, self.zi)
+        return out
+    def stream(self, chunks):
+        # generator over the filtered chunks of an iterable of chunks
+        for chunk in chunks:
+            yield self.process_chunk(chunk)
+    @profiling.traced('DataFilter.filter_file')
+    def filter_file(self, filename, out_filename, labels, chunk_size=65536):
+        # filters the labels of a .bin file out-of-core into a new .bin file with the same header.
+        # the input is memory-mapped and processed chunk_size rows at a time, so memory use does not grow
+        # with the file. Filtered values are cast back to the label's dtype.
+        name, all_labels, dtypes, dtype, offset = read_header(filename)
+        data = load_data(filename, return_dict=False, mmap=True)
+        zis = {label: None for label in labels}
+        with open(filename, 'rb') as f:
+            header = f.read(offset)
+        with open(out_filename, 'wb') as f:
+            f.write(header)
+            for start in range(0, len(data), chunk_size):
+                chunk = np.array(data[start:start+chunk_size])
+                for label in labels:
+                    x = chunk[label]
+                    if zis[label] is None:
+                        zis[label] = self.initial_state(x[0])
+                    out, zis[label] = self._filter(x, zis[label])
+                    chunk[label] = out
+                f.write(chunk.tobytes())
+        return
+
+class FilterBank():
+    """ bank of bandpass filters sharing one notch cascade. Every chunk is notch-filtered once and then run
+    through the butterworth sections of every band, optionally with the channels split across threads """
+    def __init__(self, bands, fn=[], q=[], order=2, fs=1000.0, envelope_fc=None, workers=1, precision=None):
+        # bands: list of (low, high) band edges in Hz
+        # fn, q: notch filter frequencies and q factors, applied once before all the bands
+        # order: butterworth order of every band
+        # envelope_fc: cutoff (in Hz) of the lowpass that smooths the squared band signals into envelopes
+        # workers: number of threads to split the channels across. scipy's sosfilt releases the GIL.
+        # precision: 'single' or 'double' (None: PRECISION) of all the filters and outputs
+        self.bands = [tuple(band) for band in bands]
+        self.fs = fs
+        self.workers = workers
+        self.dtype = precision_dtypes(precision)[0]
+        self.notch = DataFilter(fn=fn, q=q, fs=fs, precision=precision) if len(fn) > 0 else None
+        self.filters = [DataFilter(fc=list(band), btype='bandpass', order=order, fs=fs, precision=precision) for band in self.bands]
+        self.smoother = DataFilter(fc=envelope_fc, btype='lowpass', order=2, fs=fs, precision=precision) if envelope_fc is not None else None
+        self.state = None # filter states carried between chunks by process_chunk
+        self._executor = None
+        return
+    def __len__(self):
+        return len(self.filters)
+    def initial_state(self, x0):
+        # steady-state filter states for a signal starting at sample x0 of shape (channels,).
+        # the notch passes DC unchanged, so every band starts from x0 as well.
+        state = {'notch': None if self.notch is None else self.notch.initial_state(x0),
+                 'bands': [f.initial_state(x0) for f in self.filters], 'envelope': None}
+        return state
+    def _filter_block(self, data, state):
+        # filters data (time, channels) through the notch and every band. returns the band signals
+        # (time, channels, bands), the new state and the smoothed band powers (None without envelope_fc)
+        new_state = {'notch': None, 'bands': [], 'envelope': None}
+        if self.notch is not None:
+            data, new_state['notch'] = self.notch._filter(data, state['notch'])
+        out = np.empty(data.shape + (len(self.filters),), dtype=self.dtype)
+        for j, f in enumerate(self.filters):
+            out[:, :, j], zo = f._filter(data, state['bands'][j])
+            new_state['bands'].append(zo)
+        power = None
+        if self.smoother is not None:
+            power = out**2
+            zi = state['envelope']
+            if zi is None:
+                zi = self.smoother.zi0[:, :, None, None]*power[0]
+            power, new_state['envelope'] = self.smoother._filter(power, zi)
+        return out, new_state, power
+    def _slice_state(self, state, cols):
+        # the filter states of the channels cols. every state array has the channels on axis 2.
+        return {'notch': None if state['notch'] is None else state['notch'][:, :, cols],
+                'bands': [zi[:, :, cols] for zi in state['bands']],
+                'envelope': None if state['envelope'] is None else state['envelope'][:, :, cols]}
+    def _run(self, data, state):
+        if self.workers <= 1 or data.shape[1] < 2:
+            return self._filter_block(data, state)
+        if self._executor is None:
+            import concurrent.futures
+            self._executor = concurrent.futures.ThreadPoolExecutor(self.workers)
+        blocks = [cols for cols in np.array_split(np.arange(data.shape[1]), self.workers) if len(cols) > 0]
+        results = list(self._executor.map(lambda cols: self._filter_block(data[:, cols], self._slice_state(state, cols)), blocks))
+        out = np.concatenate([result[0] for result in results], axis=1)
+        states = [result[1] for result in results]
+        new_state = {'notch': None, 'bands': [], 'envelope': None}
+        if self.notch is not None:
+            new_state['notch'] = np.concatenate([s['notch'] for s in states], axis=2)
+        new_state['bands'] = [np.concatenate([s['bands'][j] for s in states], axis=2) for j in range(len(self.filters))]
+        power = None
+        if self.smoother is not None:
+            new_state['envelope'] = np.concatenate([s['envelope'] for s in states], axis=2)
+            power = np.concatenate([result[2] for result in results], axis=1)
+        return out, new_state, power
+    @profiling.traced('FilterBank.filter_data')
+    def filter_data(self, data):
+        # data should have shape (time, channels). returns the band signals of shape (time, channels, bands)
+        data = np.asarray(data).reshape((len(data), -1))
+        out, state, power = self._run(data, self.initial_state(data[0]))
+        return out
+    def reset(self):
+        # forget the streaming state, so that the next chunk starts a new stream
+        self.state = None
+    def process_chunk(self, chunk, output='signal'):
+        # filters the next chunk (time, channels) of a stream, carrying the filter states between calls.
+        # output: 'signal' returns the band signals (time, channels, bands), 'envelope' the smoothed amplitude
+        # envelopes (time, channels, bands, needs envelope_fc) and 'power' the mean power over the chunk (channels, bands)
+        if output == 'envelope' and self.smoother is None:
+            raise ValueError('envelope output needs envelope_fc')
+        chunk = np.asarray(chunk).reshape((len(chunk), -1))
+        if len(chunk) == 0:
+            return np.zeros((0, chunk.shape[1], len(self.filters)), dtype=self.dtype) if output != 'power' else np.full((chunk.shape[1], len(self.filters)), np.nan)
+        if self.state is None:
+            self.state = self.initial_state(chunk[0])
+        out, self.state, power = self._run(chunk, self.state)
+        if output == 'signal':
+            return out
+        if output == 'envelope':
+            return np.sqrt(np.maximum(power, 0.0))
+        if output == 'power':
+            return np.mean(out**2, axis=0)
+        raise ValueError(f'unknown output {output!r}')
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        return
+
+class Decimator():
+    """ anti-aliased decimation by an integer factor q: a lowpass at the new nyquist frequency followed by keeping
+    every q-th sample, in one polyphase pass that only computes the kept samples """
+    def __init__(self, q, ftype='fir', half_len=10):
+        # q: decimation factor. 1 passes the data through unchanged
+        # ftype: 'fir' for a linear-phase kaiser-window FIR of 2*q*half_len+1 taps (as scipy.signal.resample_poly),
+        #   'iir' for an order 8 chebyshev type I filter (as scipy.signal.decimate)
+        # half_len: FIR length in output samples on either side of the center tap. longer is sharper.
+        import scipy.signal
+        self.q = int(q)
+        self.ftype = ftype
+        if self.q < 1:
+            raise ValueError('q must be at least 1')
+        if ftype not in ('fir', 'iir'):
+            raise ValueError('ftype must be fir or iir')
+        if self.q == 1:
+            self.delay = 0 # nothing to filter: an identity
+        elif ftype == 'fir':
+            self.h = scipy.signal.firwin(2*self.q*half_len+1, 1.0/self.q, window=('kaiser', 5.0))
+            self.delay = half_len # group delay of the filter in output samples
+        elif ftype == 'iir':
+            self.sos = scipy.signal.cheby1(8, 0.05, 0.8/self.q, output='sos')
+            self.delay = 0 # no constant group delay
+        self.reset()
+        return
+    def reset(self):
+        # forget the streaming state, so that the next chunk starts a new stream
+        self.history = None # FIR: the last 2*q*half_len input samples. IIR: filter state
+        self.phase = 0 # index in the next chunk of the next sample to keep
+        return
+    @profiling.traced('Decimator.decimate')
+    def decimate(self, x):
+        # decimates x of shape (time, ...) along time. returns ceil(len(x)/q) samples, out[m] aligned with x[m*q].
+        # FIR is applied centered (zero phase); IIR forward and backward (zero phase).
+        import scipy.signal
+        x = np.asarray(x)
+        if self.q == 1:
+            return x.copy()
+        n_out = -(-len(x)//self.q)
+        if self.ftype == 'fir':
+            y = scipy.signal.upfirdn(self.h, x, 1, self.q, axis=0)
+            return y[self.delay:self.delay+n_out]
+        if len(x) <= 3*(2*len(self.sos) + 1):
+            return scipy.signal.sosfilt(self.sos, x, axis=0)[0::self.q] # too short for the padding of sosfiltfilt
+        return scipy.signal.sosfiltfilt(self.sos, x, axis=0)[0::self.q]
+    def process_chunk(self, chunk):
+        # decimates the next chunk (time, ...) of a stream, carrying the filter state between calls. the output is
+        # causal: the concatenated FIR output lags decimate() by delay samples, which flush() returns at the end,
+        # so concatenate(outputs + [flush()])[delay:None] equals decimate() of the whole stream.
+        import scipy.signal
+        chunk = np.asarray(chunk)
+        if self.q == 1:
+            return chunk.copy()
+        if self.ftype == 'fir':
+            if self.history is None:
+                self.history = np.zeros((len(self.h)-1, *chunk.shape[1:None]), dtype=np.result_type(chunk, self.h))
+            x = np.concatenate([self.history, chunk], axis=0)
+            # first kept sample is x[len(h)-1+phase]; the polyphase filter over x[phase:] yields it as its
+            # output number (len(h)-1)/q (an integer, as len(h)-1 = 2*q*half_len)
+            y = scipy.signal.upfirdn(self.h, x[self.phase:None], 1, self.q, axis=0)
+            first = (len(self.h)-1)//self.q
+            n_out = len(range(self.phase, len(chunk), self.q))
+            out = y[first:first+n_out]
+            self.history = x[len(x)-(len(self.h)-1):None]
         else:
-            zi = (self.zi0[..., None]@data[0].reshape((1, -1)))
-            out, zo = scipy.signal.sosfilt(self.sos, data, axis=0, zi=zi)
+            if self.history is None:
+                self.history = np.zeros((len(self.sos), 2, *chunk.shape[1:None]))
+            y, self.history = scipy.signal.sosfilt(self.sos, chunk, axis=0, zi=self.history)
+            out = y[self.phase::self.q]
+        self.phase = (self.phase - len(chunk)) % self.q
+        return out
+    def flush(self):
+        # FIR: the last delay samples of the stream, computed by feeding zeros, and resets the stream. None for IIR
+        # and q=1, which have no delay
+        if self.ftype != 'fir' or self.history is None:
+            self.reset()
+            return None
+        out = self.process_chunk(np.zeros((self.delay*self.q, *self.history.shape[1:None]), dtype=self.history.dtype))
+        self.reset()
         return out
+    def decimate_data(self, data, labels=None, name=None):
+        # decimates a data dict (or structured array) like load_data's into a new dict of the same shape. labels are
+        # lowpass filtered (None: the floating point labels); the other labels, e.g. time stamps or task state, keep
+        # every q-th sample, aligned with the filtered ones. Filtered labels keep their dtype.
+        all_labels = data['labels'] if isinstance(data, dict) else list(data.dtype.names)
+        if labels is None:
+            labels = [label for label in all_labels if np.issubdtype(data[label].dtype, np.floating)]
+        out_dict = {}
+        for label in all_labels:
+            if label in labels:
+                out_dict[label] = self.decimate(data[label]).astype(data[label].dtype)
+            else:
+                out_dict[label] = data[label][0::self.q]
+        if name is None:
+            name = data['name'] if isinstance(data, dict) and 'name' in data else ''
+        out_dict['name'] = name
+        out_dict['labels'] = list(all_labels)
+        out_dict['dtypes'] = [out_dict[label].dtype.str for label in all_labels]
+        return out_dict
 
-electrode_names = ['Fp1', 'Fpz', 'Fp2',
-                  'F7', 'F3', 'Fz', 'F4', 'F8',
-                  'FC5', 'FC1', 'FC2', 'FC6',
-                  'M1', 'T7', 'C3', 'Cz', 'C4', 'T8', 'M2',
-                  'CP5', 'CP1', 'CP2', 'CP6',
-                  'P7', 'P3', 'Pz', 'P4', 'P8', 'POz',
-                  'O1', 'O2', 'EOG',
-                  'AF7', 'AF3', 'AF4', 'AF8',
-                  'F5', 'F1', 'F2', 'F6',
-                  'FC3', 'FCz', 'FC4',
-                  'C5', 'C1', 'C2', 'C6',
-                  'CP3', 'CP4',
-                  'P5', 'P1', 'P2', 'P6',
-                  'PO5', 'PO3', 'PO4', 'PO6',
-                  'FT7', 'FT8', 'TP7', 'TP8',
-                  'PO7', 'PO8', 'Oz']
-
-inds_original = np.array([
-    [0, 4], [0, 5], [0, 6], [2, 1], [2, 3], [2, 5], [2, 7], [2, 9],
-    [3, 2], [3, 4], [3, 6], [3, 8], [4, 0], [4, 1], [4, 3], [4, 5], [4, 7], [4, 9], [4, 10], 
-    [5, 2], [5, 4], [5, 6], [5, 8], [6, 1], [6, 3], [6, 5], [6, 7], [6, 9],
-    [7, 5], [8, 4], [8, 6], [0, 0], [1, 1], [1, 3], [1, 7], [1, 9],
-    [2, 2], [2, 4], [2, 6], [2, 8], [3, 3], [3, 5], [3, 7],
-    [4, 2], [4, 4], [4, 6], [4, 8], [5, 3], [5, 7],
-    [6, 2], [6, 4], [6, 6], [6, 8],
-    [7, 2], [7, 3], [7, 7], [7, 8],
-    [3, 1], [3, 9], [5, 1], [5, 9], [7, 1], [7, 9], [8, 5]
-])
-GRIDSHAPE = (11, 9)
-
-inds_grid = np.zeros(GRIDSHAPE, dtype='int')*np.nan
-for i, ind in enumerate(inds_original):
-    inds_grid[ind[1], ind[0]] = i
-neighbors = []
-for i, ind in enumerate(inds_original):
-    iy, ix = ind
-    neighbors_i = []
-    if ix > 0 and ~np.isnan(inds_grid[ix-1, iy]):
-        neighbors_i.append(int(inds_grid[ix-1, iy]))
-    if ix < GRIDSHAPE[0]-1 and ~np.isnan(inds_grid[ix+1, iy]):
-        neighbors_i.append(int(inds_grid[ix+1, iy]))
-    if iy > 0 and ~np.isnan(inds_grid[ix, iy-1]):
-        neighbors_i.append(int(inds_grid[ix, iy-1]))
-    if iy < GRIDSHAPE[1]-1 and ~np.isnan(inds_grid[ix, iy+1]):
-        neighbors_i.append(int(inds_grid[ix, iy+1]))
-    neighbors.append(neighbors_i)
-
-adjacency = np.zeros((64, 64))
-for i, neighbors_i in enumerate(neighbors):
-    adjacency[i, neighbors_i] = 1
-
-next_neighbors = [] # if horizontal distance is 2 or vertical distance is 2
-for i, ind in enumerate(inds_original):
-    iy, ix = ind
-    neighbors_i = []
-    if ix > 1 and ~np.isnan(inds_grid[ix-2, iy]):
-        neighbors_i.append(int(inds_grid[ix-2, iy]))
-    if ix < GRIDSHAPE[0]-2 and ~np.isnan(inds_grid[ix+2, iy]):
-        neighbors_i.append(int(inds_grid[ix+2, iy]))
-    if iy > 1 and ~np.isnan(inds_grid[ix, iy-2]):
-        neighbors_i.append(int(inds_grid[ix, iy-2]))
-    if iy < GRIDSHAPE[1]-2 and ~np.isnan(inds_grid[ix, iy+2]):
-        neighbors_i.append(int(inds_grid[ix, iy+2]))
-    next_neighbors.append(neighbors_i)
-next_adjacency = np.zeros((64, 64))
-for i, neighbors_i in enumerate(next_neighbors):
-    next_adjacency[i, neighbors_i] = 1
-
-
-
-
-
-
-def sliding_dft(x, N, NN, downsample=1, dtype='complex64'):
+class RunningStats():
+    """ per-channel count, mean, variance, min, max and covariance of a signal seen one chunk at a time. Chunks are
+    reduced on their own and merged with Chan's parallel update of the centered sums, which is as stable as Welford's
+    per-sample update but vectorized. Partial stats of different chunks, files or processes merge into the stats of
+    the concatenated data, in any order """
+    def __init__(self, covariance=True):
+        # covariance: also accumulate the (channels, channels) co-moment matrix
+        self.covariance = covariance
+        self.count = 0
+        self.mean = None # (channels,)
+        self.m2 = None # sums of squared deviations from the mean, (channels,)
+        self.comoment = None # sums of products of deviations, (channels, channels)
+        self.min = None
+        self.max = None
+        return
+    def _merge(self, count, mean, m2, comoment, xmin, xmax):
+        if count == 0:
+            return
+        if self.count == 0:
+            self.count, self.mean, self.m2, self.comoment, self.min, self.max = count, mean, m2, comoment, xmin, xmax
+            return
+        if mean.shape != self.mean.shape:
+            raise ValueError('stats of {} channels cannot be merged with stats of {} channels'.format(len(mean), len(self.mean)))
+        n = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta*(count/n)
+        self.m2 = self.m2 + m2 + delta**2*(self.count*count/n)
+        if self.comoment is not None:
+            self.comoment = self.comoment + comoment + np.outer(delta, delta)*(self.count*count/n)
+        self.min = np.minimum(self.min, xmin)
+        self.max = np.maximum(self.max, xmax)
+        self.count = n
+        return
+    def update(self, chunk):
+        # adds a chunk of shape (time, channels) or (time,), e.g. a label of load_data or the output of
+        # DataFilter.process_chunk. computed in float64 whatever the dtype of chunk. returns self
+        chunk = np.asarray(chunk)
+        x = chunk.reshape((len(chunk), -1)).astype('float64', copy=False)
+        if len(x) == 0:
+            return self
+        mean = np.mean(x, axis=0)
+        d = x - mean
+        comoment = d.T@d if self.covariance else None
+        m2 = np.diagonal(comoment).copy() if self.covariance else np.einsum('ij,ij->j', d, d)
+        self._merge(len(x), mean, m2, comoment, np.min(x, axis=0), np.max(x, axis=0))
+        return self
+    def merge(self, other):
+        # adds the stats of other (of the same number of channels). returns self
+        comoment = other.comoment if self.covariance else None
+        if self.covariance and other.count > 0 and other.comoment is None:
+            raise ValueError('cannot merge stats without covariance into stats with covariance')
+        self._merge(other.count, other.mean, other.m2, comoment, other.min, other.max)
+        return self
+    def stream(self, chunks):
+        # generator passing the chunks of an iterable through unchanged while adding them, e.g.
+        # stats.stream(data_filter.stream(chunks))
+        for chunk in chunks:
+            self.update(chunk)
+            yield chunk
+    def var(self, ddof=0):
+        if self.count <= ddof:
+            return np.full(np.shape(self.m2), np.nan)
+        return self.m2/(self.count - ddof)
+    def std(self, ddof=0):
+        return np.sqrt(self.var(ddof))
+    def cov(self, ddof=1):
+        if self.comoment is None:
+            raise ValueError('covariance was not accumulated')
+        if self.count <= ddof:
+            return np.full(self.comoment.shape, np.nan)
+        return self.comoment/(self.count - ddof)
+    def corr(self):
+        # correlation matrix. constant channels give nan
+        std = np.sqrt(np.diagonal(self.cov(0)))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.cov(0)/np.outer(std, std)
+    def normalize(self, x, ddof=0, dtype=None):
+        # z-scores x (time, channels) per channel with the accumulated mean and std. constant channels give 0.
+        # dtype: of the result (None: that of x if floating, else float64)
+        x = np.asarray(x)
+        if dtype is None:
+            dtype = x.dtype if np.issubdtype(x.dtype, np.floating) else 'float64'
+        std = self.std(ddof)
+        scale = np.divide(1.0, std, out=np.zeros_like(std), where=std > 0)
+        shape = np.shape(x)[1:None]
+        return ((x - self.mean.reshape(shape))*scale.reshape(shape)).astype(dtype, copy=False)
+    def to_dict(self):
+        # plain arrays, e.g. to save with np.savez
+        out = {'count': np.int64(self.count)}
+        for name in ('mean', 'm2', 'comoment', 'min', 'max'):
+            if getattr(self, name) is not None:
+                out[name] = getattr(self, name)
+        return out
+    @classmethod
+    def from_dict(cls, d):
+        stats = cls(covariance='comoment' in d)
+        if int(d['count']) > 0:
+            stats._merge(int(d['count']), *[np.asarray(d[name]) if name in d else None for name in ('mean', 'm2', 'comoment', 'min', 'max')])
+        return stats
+
+@profiling.traced('data_util.channel_stats')
+def channel_stats(filename, label='eeg', data_filter=None, covariance=True, chunk_size=65536, start=None, end=None):
+    """ RunningStats of one label of a .bin file in one pass over the memory-mapped records, chunk_size rows at a
+    time, optionally after streaming them through a DataFilter (which is reset first) """
+    data = load_data(filename, labels=[label], mmap=True, start=start, end=end)[label]
+    stats = RunningStats(covariance)
+    if data_filter is not None:
+        data_filter.reset()
+    for i in range(0, len(data), chunk_size):
+        chunk = data[i:i+chunk_size]
+        stats.update(chunk if data_filter is None else data_filter.process_chunk(chunk))
+    return stats
+
+def __getattr__(name):
+    # the grid tables of the 64-channel cap are built in memory on first use by topology.Montage instead of at import
+    if name in ('inds_grid', 'neighbors', 'adjacency', 'next_neighbors', 'next_adjacency'):
+        montage = topology.get_montage()
+        tables = {
+            'inds_grid': montage.inds_grid,
+            'neighbors': montage.neighbors(1),
+            'adjacency': montage.adjacency(1).toarray(),
+            'next_neighbors': montage.neighbors(2), # if horizontal distance is 2 or vertical distance is 2
+            'next_adjacency': montage.adjacency(2).toarray(),
+        }
+        globals().update(tables)
+        return tables[name]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+def _chunk_size(zs, D, NN, complex_dtype, block_size=None):
+    # samples per chunk of method chunked: block_size, or None to keep the chunk (P, D, NN) in cache. capped so that
+    # the phases zs**(-q) and zs**(p+1) of zs off the unit circle grow by at most eps**(-1/4) of complex_dtype (8e3 in
+    # double, 60 in single) over a chunk, as the unrolled sums carry their rounding and overflow beyond that
+    P = max(16, 2**15//(D*NN)) if block_size is None else block_size
+    log_r = np.max(np.abs(np.log(np.abs(zs)))) if len(zs) > 0 else 0.0
+    if log_r > 0:
+        P = min(P, max(1, int(np.log(np.finfo(complex_dtype).eps**-0.25)/log_r)))
+    return P
+
+def _sliding_method(L, N, NN, D, downsample, P):
+    # rough cost (in units of one complex multiply-add) of each method. The per-sample and per-chunk python
+    # overheads are counted as a fixed number of operations. P: samples per chunk of method chunked
+    n_out = int(np.ceil(L/downsample))
+    costs = {
+        'recurrence': L*(3*D*NN + 2000),
+        'chunked': L*D*NN*(2 + 2/downsample) + L*200 + np.ceil(L/P)*8000,
+        'matmul': n_out*D*N*NN/4, # real blas matmul
+        'fft': n_out*D*N*max(np.log2(N), 1.0),
+    }
+    return min(costs, key=costs.get)
+
+def _sliding_sum(x, N, zs, in_ratio, downsample, dtype, method, block_size, fft_bins=None, precision=None):
+    # Computes out[i] = zs*(out[i-1] + in_ratio*x[i] - x[i-N]) with x[i] = 0 for i < 0, keeping every
+    # downsample-th row. With in_ratio*zs**N = 1 this is out[i] = in_ratio*sum_{m=0}^{N-1} x[i-m]*zs**(m+1),
+    # the form of both sliding_dft (in_ratio = 1) and sliding_z (in_ratio = zs**(-N)).
+    # The coefficients are computed in complex128 and every intermediate is held in the dtypes of precision.
+    real_dtype, complex_dtype = precision_dtypes(precision)
+    x = np.asarray(x)
+    compute_dtype = complex_dtype if np.iscomplexobj(x) else real_dtype
+    if x.dtype.itemsize > compute_dtype.itemsize:
+        x = x.astype(compute_dtype) # narrower data is converted block by block (chunk, or block of windows)
+    zs = np.asarray(zs, dtype='complex128')
+    in_ratio = np.asarray(in_ratio, dtype='complex128')
+    L, D = x.shape
+    NN = len(zs)
+    n_out = int(np.ceil(L/downsample))
+    if method == 'auto':
+        method = _sliding_method(L, N, NN, D, downsample, _chunk_size(zs, D, NN, complex_dtype, block_size))
+        if method == 'fft' and fft_bins is None:
+            method = 'matmul'
+    out = np.zeros((n_out, D, NN), dtype=dtype)
+    if method == 'recurrence':
+        z_i = np.zeros((D, NN), dtype=dtype)
+        zs_c, in_ratio_c = zs.astype(complex_dtype), in_ratio.astype(complex_dtype)
+        for i in range(0, L):
+            old_x = x[i-N, :, None] if i-N >= 0 else 0
+            z_i = (z_i - old_x + x[i, :, None]*in_ratio_c)*zs_c
+            if i % downsample == 0:
+                out[i//downsample] = z_i
+        return out
+    if method in ('fft', 'matmul'):
+        if block_size is None:
+            # keep the per-block window copies around 2**22 elements
+            block_size = max(1, 2**22//(D*N))
+        # padded so that the window ending at sample i is xp[i:i+N]
+        xp = np.concatenate([np.zeros((N-1, D), dtype=x.dtype), x], axis=0)
+        windows = slidingwindow(xp, N, stride=downsample) # (n_out, N, D), no copy
+        if method == 'matmul':
+            V = in_ratio*zs[None, :]**(N - np.arange(N)[:, None]) # (N, NN)
+            if not np.iscomplexobj(x):
+                Vr, Vi = np.ascontiguousarray(V.real, dtype=real_dtype), np.ascontiguousarray(V.imag, dtype=real_dtype)
+            else:
+                V = V.astype(complex_dtype)
+        else:
+            real_fft = not np.iscomplexobj(x) and np.max(fft_bins) <= N//2
+        for j0 in range(0, n_out, block_size):
+            # (b, D, N), contiguous along the window so that the fft and the matmul are single batched calls
+            w = np.ascontiguousarray(windows[j0:j0+block_size].transpose(0, 2, 1), dtype=compute_dtype)
+            if method == 'fft':
+                if real_fft:
+                    out[j0:j0+block_size] = np.fft.rfft(w, axis=-1)[..., fft_bins]
+                else:
+                    out[j0:j0+block_size] = np.fft.fft(w, axis=-1)[..., fft_bins]
+            elif np.iscomplexobj(x):
+                out[j0:j0+block_size] = w @ V
+            else:
+                o = out[j0:j0+block_size]
+                o.real = w @ Vr
+                o.imag = w @ Vi
+        return out
+    if method == 'chunked':
+        # the recurrence unrolled over chunks of P samples starting at i0:
+        # out[i0+p] = zs**(p+1)*(out[i0-1] + cumsum_{q<=p} zs**(-q)*(in_ratio*x[i0+q] - x[i0+q-N]))
+        P = _chunk_size(zs, D, NN, complex_dtype, block_size)
+        logz = np.log(zs)
+        phase_in = np.exp(-np.arange(P)[:, None]*logz[None, :]) # zs**(-q)
+        phase_out = np.exp((np.arange(P)[:, None]+1)*logz[None, :]) # zs**(p+1)
+        scalar_in = np.ndim(in_ratio) == 0 and in_ratio == 1.0
+        if not scalar_in:
+            phase_in_ratio = (in_ratio*phase_in).astype(complex_dtype)
+        phase_in, phase_out = phase_in.astype(complex_dtype), phase_out.astype(complex_dtype)
+        state = np.zeros((D, NN), dtype=complex_dtype)
+        C = np.zeros((P, D, NN), dtype=complex_dtype)
+        for i0 in range(0, L, P):
+            i1 = min(i0 + P, L)
+            n = i1 - i0
+            # in the compute dtype, so that narrower data is not rounded in x_new - x_old, an error that the state
+            # would carry to the end
+            x_new = np.asarray(x[i0:i1], dtype=compute_dtype)
+            x_old = np.zeros((n, D), dtype=compute_dtype) # x[i-N], 0 for i < N
+            if i1 > N:
+                x_old[max(i0-N, 0)-(i0-N):None] = x[max(i0-N, 0):i1-N]
+            if scalar_in:
+                np.multiply((x_new - x_old)[:, :, None], phase_in[0:n, None, :], out=C[0:n])
+            else:
+                np.multiply(x_new[:, :, None], phase_in_ratio[0:n, None, :], out=C[0:n])
+                C[0:n] -= x_old[:, :, None]*phase_in[0:n, None, :]
+            np.cumsum(C[0:n], axis=0, out=C[0:n])
+            # only the rows that are kept get the carried state and the output phase
+            p0 = -(-i0//downsample)*downsample - i0
+            j0 = (i0 + p0)//downsample
+            rows = np.arange(p0, n, downsample)
+            out[j0:j0+len(rows)] = (C[rows] + state)*phase_out[rows, None, :]
+            state = (C[n-1] + state)*phase_out[n-1, None, :]
+        return out
+    raise ValueError('method must be one of auto, fft, matmul, chunked or recurrence')
+
+@profiling.traced('data_util.sliding_dft')
+def sliding_dft(x, N, NN, downsample=1, dtype='complex64', method='auto', block_size=None, precision=None):
     # x: 2-dimensional with shape (L, D)
     # N: N-point dft
     # NN: number of points to take from dft OR array-like indices
-    L = x.shape[0]
-    W = scipy.linalg.dft(N)
+    # method: 'fft' (batched fft of strided windows), 'matmul' (windows times the selected dft columns),
+    #   'chunked' (the recurrence unrolled over chunks with cumulative sums), 'recurrence' (the per-sample
+    #   loop) or 'auto' to pick the cheapest from N, NN, L and downsample.
+    # block_size: output rows per block for fft/matmul, samples per chunk for chunked. None sizes them
+    #   from N, NN and D.
+    # precision: 'single' or 'double' (None: PRECISION) of the intermediate math. dtype is that of the output only.
+    # out[j, :, k] is the N-point dft (bin k) of the N samples ending at sample j*downsample.
     if isinstance(NN, int):
-        ratio = np.conj(W[1, 0:NN])
+        bins = np.arange(NN)
     else:
-        ratio = np.conj(W[1, NN])
-    for i in range(0, L):
-        old_x = x[i-N] if i-N > 0 else 0
-    if not isinstance(NN, int):
-        NN = len(NN)
-    dft_out = np.zeros((int(np.ceil(L/downsample)), x.shape[1], NN), dtype=dtype)
-    dft_i = np.zeros((x.shape[1], NN), dtype=dtype)
-    j = 0
-    for i in range(0, L):
-        old_x = x[i-N, :, None] if i-N >= 0 else 0
-        dft_i = (dft_i - old_x + x[i, :, None])*ratio
-        if i % downsample == 0:
-            dft_out[j] = dft_i
-            j += 1
-    return dft_out
-
-def sliding_z(x, N, zs, dtype='complex64'):
+        bins = np.asarray(NN)
+    ratio = np.exp(2j*np.pi*bins/N)
+    return _sliding_sum(x, N, ratio, 1.0, downsample, dtype, method, block_size, fft_bins=bins, precision=precision)
+
+@profiling.traced('data_util.sliding_z')
+def sliding_z(x, N, zs, dtype='complex64', downsample=1, method='auto', block_size=None, precision=None):
     # x: 2-dimensional with shape (L, D), i.e. (length, dimensions)
     # N: N-point z-transform
     # zs: 1-dimensional, points to evaluate z-transform (likely on unit circle)
-    in_ratio = zs**(-N)
-    NN = len(zs)
-    L = x.shape[0]
-    z_out = np.zeros((L, x.shape[1], NN), dtype=dtype)
-    z_i = np.zeros((x.shape[1], NN), dtype=dtype)
-    for i in range(0, L):
-        old_x = x[i-N, :, None] if i-N >= 0 else 0
-        z_i = (z_i - old_x + x[i, :, None]*in_ratio)*zs
-        z_out[i] = z_i
-    return z_out
+    # method, block_size, precision: as in sliding_dft, without method 'fft'
+    if method == 'fft':
+        raise ValueError('method fft is only available for sliding_dft')
+    zs = np.asarray(zs)
+    return _sliding_sum(x, N, zs, zs**(-N), downsample, dtype, method, block_size, precision=precision)
 
 def slidingwindow(data, width, stride=1, dilation=1, batch_dim=False):
     # data is of shape (batch, length, *data_dims) if batch_dim=True
@@ -274,19 +985,20 @@ def slidingwindow(data, width, stride=1, dilation=1, batch_dim=False):
         Ndata = len(range(windowwidth-1, data.shape[0], stride))
         shape=(Ndata, width, *data.shape[1:None])
     
+    # the strides of data are used as they are, so views that are not contiguous, e.g. a label of a
+    # (memory-mapped) structured array, are windowed without a copy
     if isinstance(data, np.ndarray):
         if batch_dim:
-            strides = (data.itemsize*np.product(data.shape[1:None]), stride*data.strides[1], 
-                       dilation*data.itemsize*np.product(data.shape[2:None]), *data.strides[2:None])
+            strides = (data.strides[0], stride*data.strides[1], dilation*data.strides[1], *data.strides[2:None])
         else:
-            strides = (stride*data.strides[0], dilation*data.itemsize*np.product(data.shape[1:None]), *data.strides[1:None])
+            strides = (stride*data.strides[0], dilation*data.strides[0], *data.strides[1:None])
         return np.lib.stride_tricks.as_strided(data, shape=shape, strides=strides)
-    if isinstance(data, torch.Tensor):
+    if _is_tensor(data):
+        import torch
         if batch_dim:
-            strides = (np.product(data.shape[1:None]), stride*data.stride()[1], 
-                       dilation*np.product(data.shape[2:None]), *data.stride()[2:None])
+            strides = (data.stride()[0], stride*data.stride()[1], dilation*data.stride()[1], *data.stride()[2:None])
         else:
-            strides = (stride*data.stride()[0], dilation*np.product(data.shape[1:None]), *data.stride()[1:None])
+            strides = (stride*data.stride()[0], dilation*data.stride()[0], *data.stride()[1:None])
         return torch.as_strided(data, size=shape, stride=strides)
     raise ValueError('data must be a numpy array or a torch Tensor')
     return
@@ -299,9 +1011,8 @@ def subsequences_lims(length, width=1, dilation=1, position=-1):
     # out[0] <= inds < out[1], left-inclusive, right-exclusive
     return (offset, length - (width-1-position)*dilation)
 
-def subsequences(data, inds, width=1, dilation=1, position=-1):
-    # returns windows of width width and spread (width-1)*dilation + 1 such that out[:, position, :] = data[inds]
-    # Should have -((width-1)*dilation+1) <= position < (width-1)*dilation+1
+def _subsequences_starts(data, inds, width=1, dilation=1, position=-1):
+    # checks the arguments of subsequences and returns the index of the window of each ind in slidingwindow(data)
     if position < 0:
         if position < -width:
             raise ValueError('position is less than -width.')
@@ -311,7 +1022,7 @@ def subsequences(data, inds, width=1, dilation=1, position=-1):
             raise ValueError('position is greater than or equal to the width. (0-indexing)')
         offset = position*dilation
     if isinstance(inds, np.ndarray):
-        if np.issubdtype(inds.dtype, np.bool):
+        if np.issubdtype(inds.dtype, np.bool_):
             if len(inds) != len(data):
                 raise ValueError('Boolean indexes of length {} mismatched with data of length {}'.format(len(inds), len(data)))
             inds = inds.nonzero()[0]
@@ -322,5 +1033,134 @@ def subsequences(data, inds, width=1, dilation=1, position=-1):
             if np.max(inds) + (width-1-position)*dilation >= data.shape[0]:
                 raise ValueError('Maximum index {} plus (width-1-position)*dilation {} is greater than or equal to length {} of data.'.format(
                     np.max(inds), (width-1-position)*dilation, data.shape[0]))
+    return np.asarray(inds)-offset
+
+@profiling.traced('data_util.subsequences')
+def subsequences(data, inds, width=1, dilation=1, position=-1):
+    # returns windows of width width and spread (width-1)*dilation + 1 such that out[:, position, :] = data[inds]
+    # Should have -((width-1)*dilation+1) <= position < (width-1)*dilation+1
+    starts = _subsequences_starts(data, inds, width, dilation, position)
     slidingdata = slidingwindow(data, width, dilation=dilation)
-    return slidingdata[np.asarray(inds)-offset]
\ No newline at end of file
+    return slidingdata[starts]
+
+@profiling.traced('data_util.epoch_power')
+def epoch_power(data, inds, N, bins, before=0, after=None, step=1, window='hann', dtype='float32', method='auto',
+                block_size=None):
+    # time-frequency power of the epochs data[ind-before:ind+after] around the samples inds, e.g. trial starts.
+    # data: (time, channels), e.g. a memory-mapped label of load_data. only the epochs are read.
+    # N: N-point dft of every frame
+    # bins: dft bins to keep (at most N//2), bin k is at k*fs/N Hz
+    # before, after: samples of every epoch before and from ind. after defaults to N
+    # step: samples between the starts of consecutive frames
+    # window: scipy.signal.get_window window of the frames. The mean of every frame is removed first.
+    # method: 'matmul' (the frames, as a strided view, times the dft columns of bins with the window and the mean
+    #   removal folded in), 'fft' (batched rfft of contiguous copies of the frames) or 'auto' to pick the cheaper
+    # block_size: epochs per batched transform. None keeps the frames of a block around 2**22 elements.
+    # returns the power (epochs, frames, channels, bins), |dft|**2/sum(window**2), and the center of every frame
+    # in samples relative to ind. every epoch must lie inside data.
+    import scipy.signal
+    after = N if after is None else after
+    bins = np.asarray(bins)
+    if before + after < N:
+        raise ValueError('epochs of {} samples are shorter than N={}'.format(before + after, N))
+    if len(bins) > 0 and np.max(bins) > N//2:
+        raise ValueError('bins must be at most N//2')
+    if method == 'auto':
+        method = 'matmul' if len(bins) < 4*max(np.log2(N), 1.0) else 'fft'
+    if method not in ('matmul', 'fft'):
+        raise ValueError('method must be one of auto, fft or matmul')
+    if np.ndim(data) == 1:
+        data = data[:, None]
+    # one gather of all the epochs, (epochs, before+after, channels), then the frames of every epoch as a view
+    epochs = np.asarray(subsequences(data, np.asarray(inds, dtype='int64'), width=before+after, position=before), dtype=dtype)
+    # the frame means are removed below; removing the epoch means first keeps large offsets from costing precision
+    epochs -= np.mean(epochs, axis=1, keepdims=True, dtype='float64').astype(dtype)
+    frames = slidingwindow(epochs, N, stride=step, batch_dim=True) # (epochs, frames, N, channels)
+    n_epochs, n_frames, D = frames.shape[0], frames.shape[1], frames.shape[3]
+    w = scipy.signal.get_window(window, N)
+    scale = 1.0/np.sum(w**2)
+    if method == 'matmul':
+        # rows of the windowed dft, minus their sums/N, which removes the frame means: V@(x - mean(x)) = (V - V@1/N)@x
+        V = w[None, :]*np.exp(-2j*np.pi*bins[:, None]*np.arange(N)[None, :]/N)*np.sqrt(scale)
+        V = V - np.sum(V, axis=1, keepdims=True)/N
+        Vr, Vi = V.real.astype(dtype), V.imag.astype(dtype)
+    else:
+        w = w.astype(dtype)
+    if block_size is None:
+        block_size = max(1, 2**22//max(n_frames*N*D, 1))
+    out = np.empty((n_epochs, n_frames, D, len(bins)), dtype=dtype)
+    for i0 in range(0, n_epochs, block_size):
+        if method == 'matmul':
+            # (bins, N) @ (b, frames, N, channels) -> (b, frames, bins, channels), without copying the frames
+            re, im = Vr@frames[i0:i0+block_size], Vi@frames[i0:i0+block_size]
+            out[i0:i0+block_size] = (re**2 + im**2).transpose(0, 1, 3, 2)
+        else:
+            # (b, frames, channels, N), contiguous along the frame so that the fft is one batched call
+            x = np.ascontiguousarray(frames[i0:i0+block_size].transpose(0, 1, 3, 2))
+            x -= np.mean(x, axis=-1, keepdims=True)
+            x *= w
+            X = np.fft.rfft(x, axis=-1)[..., bins]
+            out[i0:i0+block_size] = (X.real**2 + X.imag**2)*np.asarray(scale, dtype=dtype)
+    centers = np.arange(n_frames)*step - before + N/2.0
+    return out, centers
+
+class SubsequenceBatches():
+    # Iterates over the windows of subsequences(data, inds, width, dilation, position) in batches of batch_size,
+    # gathering each batch from the strided view so that all the windows are never materialized at once.
+    # data: numpy array or torch Tensor of shape (length, *data_dims)
+    # targets: optional array with one entry per ind. Iteration then yields (windows, targets) pairs.
+    # shuffle: visit the windows in a new random order every epoch (every call to iter). seed seeds the order.
+    # reuse_buffer: gather every batch into the same preallocated buffer, so memory stays constant. The
+    #   yielded batch is then only valid until the next one is requested.
+    # pin_memory: allocate the buffer as a pinned torch tensor (for fast transfers to the gpu) and yield
+    #   torch tensors. Implies reuse_buffer.
+    def __init__(self, data, inds, width=1, dilation=1, position=-1, batch_size=256, targets=None, shuffle=False,
+                 seed=None, drop_last=False, reuse_buffer=False, pin_memory=False):
+        self.starts = _subsequences_starts(data, inds, width, dilation, position)
+        self.slidingdata = slidingwindow(data, width, dilation=dilation)
+        self.targets = targets
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+        self.drop_last = drop_last
+        self.buffer = None
+        if pin_memory or reuse_buffer:
+            shape = (batch_size, *self.slidingdata.shape[1:None])
+            if pin_memory or _is_tensor(data):
+                import torch
+            if _is_tensor(data):
+                self.buffer = torch.empty(shape, dtype=data.dtype, pin_memory=pin_memory)
+            elif pin_memory:
+                self.buffer = torch.empty(shape, dtype=torch.from_numpy(np.zeros(0, dtype=data.dtype)).dtype, pin_memory=True)
+            else:
+                self.buffer = np.empty(shape, dtype=data.dtype)
+        return
+    def __len__(self):
+        # number of batches per epoch
+        if self.drop_last:
+            return len(self.starts)//self.batch_size
+        return int(np.ceil(len(self.starts)/self.batch_size))
+    def _gather(self, starts):
+        if _is_tensor(self.slidingdata):
+            import torch
+            starts = torch.as_tensor(starts)
+            if self.buffer is None:
+                return self.slidingdata[starts]
+            return torch.index_select(self.slidingdata, 0, starts, out=self.buffer[0:len(starts)])
+        if self.buffer is None:
+            return self.slidingdata[starts]
+        if _is_tensor(self.buffer):
+            # numpy view of the pinned buffer, filled in place
+            np.take(self.slidingdata, starts, axis=0, out=self.buffer[0:len(starts)].numpy(), mode='clip')
+            return self.buffer[0:len(starts)]
+        # mode='clip' avoids the buffering of out that mode='raise' does. starts were checked above.
+        return np.take(self.slidingdata, starts, axis=0, out=self.buffer[0:len(starts)], mode='clip')
+    def __iter__(self):
+        order = self.rng.permutation(len(self.starts)) if self.shuffle else np.arange(len(self.starts))
+        for i in range(len(self)):
+            batch = order[i*self.batch_size:(i+1)*self.batch_size]
+            windows = self._gather(self.starts[batch])
+            if self.targets is None:
+                yield windows
+            else:
+                yield windows, self.targets[batch]
@@ -0,0 +1,139 @@
+import numpy as np
+import data_util
+import trial_util
+import session_cache
+import profiling
+import pathlib
+import argparse
+import hashlib
+import json
+import functools
+import time
+
+from plot_util import DATA_DIR
+from plot_batch import run_pool
+
+# Trial-aligned time-frequency maps of the eeg: the power of every trial, channel and frequency in frames around the
+# trial starts (the state_task transitions away from the center), averaged per target, and its change relative to a
+# baseline before the start in %, negative for a desynchronization (ERD) and positive for a synchronization (ERS).
+
+def task_to_eeg_inds(task_times, eeg_times, inds):
+    """ index of the first eeg sample at or after the time stamps of the task samples inds """
+    return np.searchsorted(np.asarray(eeg_times).flatten(), np.asarray(task_times).flatten()[inds], side='left')
+
+def sampling_rate(times, n=1000):
+    """ sampling rate in Hz from the median interval of the first n nanosecond time stamps """
+    times = np.asarray(times[0:n+1]).flatten()
+    if len(times) < 2:
+        raise ValueError('need at least 2 time stamps for the sampling rate')
+    return 1e9/np.median(np.diff(times))
+
+def target_means(values, targets):
+    """ mean of values over its first axis (one entry per trial) for every target, as one matmul.
+    returns the sorted unique targets, the number of trials of each and the means (targets, *values.shape[1:]) """
+    targets_unique, inverse = np.unique(np.ravel(targets), return_inverse=True)
+    onehot = np.zeros((len(targets_unique), len(inverse)), dtype=values.dtype)
+    onehot[inverse, np.arange(len(inverse))] = 1
+    count = np.bincount(inverse, minlength=len(targets_unique))
+    means = (onehot@values.reshape((len(inverse), -1)))/np.maximum(count, 1)[:, None].astype(values.dtype)
+    return targets_unique, count, means.reshape((len(targets_unique), *values.shape[1:None]))
+
+@profiling.traced('erd_maps.compute_erd_maps')
+def compute_erd_maps(data_path, fmin=8.0, fmax=30.0, tmin=-1.0, tmax=3.0, window=0.5, step=0.05, baseline=None,
+                     time_label='time_ns'):
+    """ per-target time-frequency maps of a session's eeg.bin around the starts of the trials in its task.bin.
+    fmin, fmax: frequency range in Hz
+    tmin, tmax: epoch around every trial start in s
+    window, step: length and spacing of the frames in s
+    baseline: (start, end) in s of the frames averaged into the reference power (default: (tmin, 0))
+    time_label: nanosecond time stamps of both files, which align the task samples with the eeg samples
+    returns a dict of arrays: target, count (trials per target), times (frame centers in s), freqs (Hz), fs,
+    power (targets, frames, channels, freqs) and erd (power relative to the baseline, in %) """
+    data_path = pathlib.Path(data_path)
+    task_data = data_util.load_data(data_path / 'task.bin', labels=['state_task', 'numCompletedBlocks', time_label], mmap=True)
+    state_task, start_inds, end_inds, targets = trial_util.segment_trials(task_data)
+    trials = targets != trial_util.CENTER_STATE
+    eeg_data = data_util.load_data(data_path / 'eeg.bin', labels=['eeg', time_label], mmap=True)
+    fs = sampling_rate(eeg_data[time_label])
+    eeg_inds = task_to_eeg_inds(task_data[time_label], eeg_data[time_label], start_inds[trials])
+    N = int(round(window*fs))
+    before, after = int(round(-tmin*fs)), int(round(tmax*fs))
+    inside = (eeg_inds - before >= 0)*(eeg_inds + after <= len(eeg_data['eeg'])) # trials with a complete epoch
+    bins = np.arange(int(np.ceil(fmin*N/fs)), int(np.floor(fmax*N/fs))+1)
+    power, centers = data_util.epoch_power(eeg_data['eeg'], eeg_inds[inside], N, bins, before, after,
+                                           step=max(1, int(round(step*fs))))
+    target, count, power = target_means(power, targets[trials][inside])
+    times = centers/fs
+    if baseline is None:
+        baseline = (tmin, 0.0)
+    in_baseline = (times >= baseline[0])*(times < baseline[1])
+    if not np.any(in_baseline):
+        raise ValueError('no frame is centered in the baseline {}'.format(baseline))
+    reference = np.mean(power[:, in_baseline], axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        erd = (power/reference - 1.0)*100.0
+    return {'target': target, 'count': count, 'times': times, 'freqs': bins*fs/N, 'fs': np.float64(fs),
+            'power': power, 'erd': erd.astype(power.dtype)}
+
+def _params_key(data_path, params):
+    key = session_cache.file_key(pathlib.Path(data_path) / 'task.bin', pathlib.Path(data_path) / 'eeg.bin')
+    return hashlib.sha1((key + json.dumps(params, sort_keys=True)).encode('utf-8')).hexdigest()
+
+@profiling.traced('erd_maps.load_erd_maps')
+def load_erd_maps(data_path, cache=None, **params):
+    """ compute_erd_maps, cached on the path, size and mtime of the session's task.bin and eeg.bin and on the
+    keyword arguments of compute_erd_maps. on a cache hit the session folder is not read """
+    if cache is None:
+        cache = session_cache.default_cache()
+    key = _params_key(data_path, params)
+    maps = cache.get(key)
+    if maps is not None:
+        maps['fs'] = float(maps['fs'])
+        return maps
+    maps = compute_erd_maps(data_path, **params)
+    cache.put(key, maps)
+    maps['fs'] = float(maps['fs'])
+    return maps
+
+@profiling.traced('erd_maps.build_erd_maps')
+def build_erd_maps(sessions, datadir=DATA_DIR, workers=None, **params):
+    """ dict of session -> load_erd_maps of every session, with the sessions processed over a process pool.
+    sessions that fail are reported and left out """
+    jobs = {session: (functools.partial(load_erd_maps, **params), pathlib.Path(datadir) / session) for session in sessions}
+    return run_pool(jobs, workers, keep_failed=False)
+
+def band_erd(maps, fmin, fmax, tmin, tmax):
+    """ mean erd (in %) over the frequencies [fmin, fmax] and frames centered in [tmin, tmax) of every target and
+    channel, (targets, channels) """
+    freqs = (maps['freqs'] >= fmin)*(maps['freqs'] <= fmax)
+    times = (maps['times'] >= tmin)*(maps['times'] < tmax)
+    return np.mean(maps['erd'][:, times][..., freqs], axis=(1, 3))
+
+if __name__ == '__main__':
+    from plot_batch import find_sessions
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sessions', nargs='+', help='session names or glob patterns, e.g. "2024-*_H1_CL_*"')
+    parser.add_argument('--datadir', default=str(DATA_DIR), help='folder containing the session folders')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: number of cpus)')
+    parser.add_argument('--fmin', type=float, default=8.0, help='lowest frequency in Hz')
+    parser.add_argument('--fmax', type=float, default=30.0, help='highest frequency in Hz')
+    parser.add_argument('--tmin', type=float, default=-1.0, help='start of the epochs relative to the trial starts in s')
+    parser.add_argument('--tmax', type=float, default=3.0, help='end of the epochs relative to the trial starts in s')
+    parser.add_argument('--window', type=float, default=0.5, help='frame length in s')
+    parser.add_argument('--step', type=float, default=0.05, help='frame spacing in s')
+    profiling.add_argument(parser)
+
+    args = parser.parse_args()
+    profiling.from_args(args)
+    sessions = find_sessions(args.sessions, args.datadir)
+    t0 = time.perf_counter()
+    maps = build_erd_maps(sessions, args.datadir, args.workers, fmin=args.fmin, fmax=args.fmax, tmin=args.tmin,
+                          tmax=args.tmax, window=args.window, step=args.step)
+    print(f'{len(maps)} sessions in {time.perf_counter() - t0:.2f} s\n')
+    print(f'{"session":<32}{"target":>7}{"trials":>7}{"mu erd %":>10}{"beta erd %":>12}')
+    for session, session_maps in maps.items():
+        # mean over the channels of the first 2 s of the trials
+        mu = np.mean(band_erd(session_maps, 8.0, 13.0, 0.0, 2.0), axis=1)
+        beta = np.mean(band_erd(session_maps, 13.0, 30.0, 0.0, 2.0), axis=1)
+        for k, target in enumerate(session_maps['target']):
+            print(f'{session:<32}{target:>7}{session_maps["count"][k]:>7}{mu[k]:>10.1f}{beta[k]:>12.1f}')
@@ -0,0 +1,175 @@
+import numpy as np
+import data_util
+import argparse
+import time
+import profiling
+
+class RingBuffer():
+    """ preallocated (capacity, channels) buffer of the most recent samples of a stream """
+    def __init__(self, capacity, channels, dtype='float64'):
+        self.data = np.zeros((capacity, channels), dtype=dtype)
+        self.capacity = capacity
+        self.count = 0 # total number of samples pushed
+        return
+    def push(self, block):
+        # appends block of shape (n, channels), overwriting the oldest samples
+        n = len(block)
+        if n > self.capacity:
+            block = block[n-self.capacity:None]
+        i = (self.count + n - len(block)) % self.capacity
+        first = min(len(block), self.capacity - i)
+        self.data[i:i+first] = block[0:first]
+        self.data[0:len(block)-first] = block[first:None]
+        self.count += n
+        return
+    def get(self, start, stop):
+        # samples [start, stop) by absolute sample number. samples before the stream started are 0.
+        if stop > self.count or start < self.count - self.capacity:
+            raise ValueError('samples {}:{} are not in the buffer (holding {}:{})'.format(
+                start, stop, max(self.count - self.capacity, 0), self.count))
+        out = np.zeros((stop-start, self.data.shape[1]), dtype=self.data.dtype)
+        lo = max(start, 0)
+        if stop > lo:
+            inds = np.arange(lo, stop) % self.capacity
+            out[lo-start:None] = self.data[inds]
+        return out
+    def latest(self, n):
+        # the n most recent samples, oldest first
+        return self.get(self.count - n, self.count)
+
+class LatencyHistogram():
+    """ histogram of latencies on log-spaced bins from 1 us to 10 s """
+    def __init__(self, bins_per_decade=10):
+        self.edges = np.logspace(-6, 1, 7*bins_per_decade+1)
+        self.counts = np.zeros(len(self.edges)+1, dtype='int64') # with under- and overflow bins
+        self.total = 0.0
+        return
+    def record(self, seconds):
+        self.counts[np.searchsorted(self.edges, seconds)] += 1
+        self.total += seconds
+        return
+    def count(self):
+        return int(self.counts.sum())
+    def percentile(self, q):
+        # upper edge of the bin containing the q-th percentile
+        n = self.count()
+        if n == 0:
+            return np.nan
+        i = np.searchsorted(np.cumsum(self.counts), q/100.0*n)
+        return self.edges[min(i, len(self.edges)-1)]
+    def summary(self):
+        n = self.count()
+        return {'count': n, 'mean': self.total/n if n > 0 else np.nan,
+                'p50': self.percentile(50), 'p99': self.percentile(99), 'max_bin': self.percentile(100)}
+
+class OnlinePipeline():
+    """ closed-loop decoding pipeline: packets of eeg -> DataFilter -> ring buffer -> sliding dft band power -> decoder.
+    the sliding dft is updated for every sample, at O(channels x bins) per sample, so a feature vector is
+    available at the end of every packet. """
+    def __init__(self, data_filter, channels, N, bins, bands=None, decoder=None, max_packet=1024):
+        # data_filter: DataFilter to run incrementally on the packets, or None
+        # N: N-point sliding dft
+        # bins: dft bins to track
+        # bands: list of lists of positions into bins, whose powers are averaged into one band feature.
+        #   None uses every bin as its own band.
+        # decoder: callable taking the (channels*bands,) feature vector, e.g. a trained model. None returns the features.
+        # max_packet: largest packet size that will be pushed
+        self.data_filter = data_filter
+        self.channels = channels
+        self.N = N
+        self.bins = np.asarray(bins)
+        self.bands = [[i] for i in range(len(self.bins))] if bands is None else bands
+        self.decoder = decoder
+        self.max_packet = max_packet
+        self.buffer = RingBuffer(N + max_packet, channels)
+        ratio = np.exp(2j*np.pi*self.bins/N)
+        self.phase_in = ratio[None, :]**(-np.arange(max_packet)[:, None]) # ratio**(-q)
+        self.phase_out = ratio[None, :]**(np.arange(max_packet)[:, None]+1) # ratio**(p+1)
+        self.band_matrix = np.zeros((len(self.bins), len(self.bands)))
+        for j, band in enumerate(self.bands):
+            self.band_matrix[band, j] = 1.0/len(band)
+        self.dft = np.zeros((channels, len(self.bins)), dtype='complex128')
+        self.latency = {stage: LatencyHistogram() for stage in ('filter', 'buffer', 'features', 'decode', 'total')}
+        return
+    def reset(self):
+        if self.data_filter is not None:
+            self.data_filter.reset()
+        self.buffer = RingBuffer(self.N + self.max_packet, self.channels)
+        self.dft[:] = 0
+        return
+    def _update_dft(self, start, packet):
+        # sliding dft recurrence dft = (dft - x[i-N] + x[i])*ratio for every sample of the packet, unrolled
+        # over the packet with a cumulative sum, as in data_util.sliding_dft(method='chunked')
+        n = len(packet)
+        if n == 0:
+            return # an empty packet leaves the dft, and so the features, as they were
+        old = self.buffer.get(start-self.N, start-self.N+n)
+        C = np.cumsum((packet - old)[:, :, None]*self.phase_in[0:n, None, :], axis=0)
+        self.dft = (C[n-1] + self.dft)*self.phase_out[n-1]
+        return
+    def push(self, packet):
+        """ processes a packet of shape (samples, channels) and returns the decoder output (or features) """
+        t0 = time.perf_counter()
+        packet = np.asarray(packet, dtype='float64')
+        if len(packet) > self.max_packet:
+            raise ValueError('packet of {} samples is larger than max_packet {}'.format(len(packet), self.max_packet))
+        if self.data_filter is not None:
+            packet = self.data_filter.process_chunk(packet)
+        t1 = time.perf_counter()
+        start = self.buffer.count
+        self.buffer.push(packet)
+        t2 = time.perf_counter()
+        self._update_dft(start, packet)
+        features = np.log10(np.abs(self.dft)**2 @ self.band_matrix + 1e-12).flatten()
+        t3 = time.perf_counter()
+        out = features if self.decoder is None else self.decoder(features)
+        t4 = time.perf_counter()
+        for stage, dt in zip(('filter', 'buffer', 'features', 'decode', 'total'), (t1-t0, t2-t1, t3-t2, t4-t3, t4-t0)):
+            self.latency[stage].record(dt)
+        return out
+    def latency_summary(self):
+        return {stage: histogram.summary() for stage, histogram in self.latency.items()}
+
+@profiling.traced('replay')
+def replay(pipeline, filename, label, packet_size=40, fs=1000.0, speed=None, max_packets=None):
+    """ replays the label of a recorded .bin file through pipeline in packets of packet_size samples.
+    speed: multiple of real time to pace the packets at. None runs as fast as possible.
+    returns the array of pipeline outputs, one per packet """
+    data = data_util.load_data(filename, labels=[label], mmap=True)[label]
+    data = data.reshape((len(data), -1))
+    outputs = []
+    t_start = time.perf_counter()
+    for i, start in enumerate(range(0, len(data), packet_size)):
+        if max_packets is not None and i >= max_packets:
+            break
+        if speed is not None:
+            # wait until the packet would have been complete
+            delay = (start + packet_size)/fs/speed - (time.perf_counter() - t_start)
+            if delay > 0:
+                time.sleep(delay)
+        outputs.append(pipeline.push(data[start:start+packet_size]))
+    return np.array(outputs)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename', help='recorded eeg .bin file to replay')
+    parser.add_argument('label', help='label of the eeg data in the file')
+    parser.add_argument('--packet-size', type=int, default=40, help='samples per packet')
+    parser.add_argument('--fs', type=float, default=1000.0, help='sampling frequency in Hz')
+    parser.add_argument('--N', type=int, default=500, help='sliding dft length in samples')
+    parser.add_argument('--speed', type=float, default=None, help='replay at this multiple of real time (default: as fast as possible)')
+    profiling.add_argument(parser)
+
+    args = parser.parse_args()
+    profiling.from_args(args)
+    channels = int(np.prod(data_util.read_header(args.filename)[3][args.label].shape)) or 1
+    bins = np.arange(int(8*args.N/args.fs), int(30*args.N/args.fs)+1) # mu and beta
+    pipeline = OnlinePipeline(data_util.DataFilter(fn=[60.0], q=[30.0], fc=[1.0, 40.0], btype='bandpass', order=2, fs=args.fs),
+                              channels, args.N, bins, max_packet=args.packet_size)
+    t0 = time.perf_counter()
+    outputs = replay(pipeline, args.filename, args.label, args.packet_size, args.fs, args.speed)
+    elapsed = time.perf_counter() - t0
+    samples = len(outputs)*args.packet_size
+    print(f'{len(outputs)} packets in {elapsed:.2f} s, {samples/args.fs/elapsed:.1f}x real time')
+    for stage, summary in pipeline.latency_summary().items():
+        print(f'{stage:<10} mean {summary["mean"]*1e6:9.1f} us   p50 < {summary["p50"]*1e6:9.1f} us   p99 < {summary["p99"]*1e6:9.1f} us')
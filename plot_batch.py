@@ -0,0 +1,129 @@
+import pathlib
+import argparse
+import concurrent.futures
+import glob
+import functools
+import profiling
+import session_meta
+
+from plot_util import DATA_DIR
+
+def find_sessions(patterns, datadir=DATA_DIR):
+    """ expands session names and glob patterns (relative to datadir) into sorted session names with a task.bin """
+    datadir = pathlib.Path(datadir)
+    sessions = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            sessions.extend(sorted(path.parent.name for path in datadir.glob(f'{pattern}/task.bin')))
+        else:
+            sessions.append(pattern)
+    return list(dict.fromkeys(sessions)) # drop duplicates, keep order
+
+def filter_sessions(sessions, datadir=DATA_DIR, copilot=None, target_dia=None, participant=None):
+    """ the sessions whose README matches the given copilot status (True: on), target diameter and participant,
+    looked up in the session index instead of reading every README """
+    criteria = {name: value for name, value in [('copilot', copilot), ('target_dia', target_dia), ('participant', participant)]
+                if value is not None}
+    if len(criteria) == 0:
+        return sessions
+    return session_meta.select_sessions(session_meta.load_index(datadir), sessions, **criteria)
+
+def is_up_to_date(plot_path, input_paths):
+    """ whether plot_path exists and is newer than all of input_paths """
+    plot_path = pathlib.Path(plot_path)
+    if not plot_path.exists():
+        return False
+    return all(plot_path.stat().st_mtime > pathlib.Path(path).stat().st_mtime for path in input_paths)
+
+def use_file_backend():
+    """ switches matplotlib to the non-interactive backend, as the figures are only rendered to files """
+    import matplotlib
+    matplotlib.use('Agg')
+
+def _plot_trajectories_job(session, datadir, render_options=None):
+    from plot_singlesession_trajectories import plot_trajectories
+    return plot_trajectories(session, datadir, **({} if render_options is None else render_options))
+
+def _plot_path_efficiency_job(sessions, datadir):
+    from plot_twosessions_path_efficiency import plot_path_efficiency
+    return plot_path_efficiency(sessions, datadir)
+
+def make_jobs(sessions, kind='trajectories', datadir=DATA_DIR, force=False, render_options=None):
+    """ returns a list of (job function, job argument) for the sessions whose figure is missing or out of date.
+    for kind 'path_efficiency' consecutive sessions are compared in pairs.
+    render_options: keyword arguments of plot_trajectories (fmt, rasterized, downsample, dpi) """
+    datadir = pathlib.Path(datadir)
+    if render_options is None:
+        render_options = {}
+    jobs = []
+    if kind == 'trajectories':
+        from plot_singlesession_trajectories import trajectory_plot_path
+        for session in sessions:
+            plot_path = trajectory_plot_path(session, render_options.get('fmt', 'pdf'))
+            if force or not is_up_to_date(plot_path, [datadir / session / 'task.bin']):
+                jobs.append((functools.partial(_plot_trajectories_job, render_options=render_options), session))
+    elif kind == 'path_efficiency':
+        from plot_twosessions_path_efficiency import path_efficiency_plot_path
+        if len(sessions) % 2 != 0:
+            raise ValueError('path_efficiency needs an even number of sessions, got {}'.format(len(sessions)))
+        for pair in zip(sessions[0::2], sessions[1::2]):
+            task_paths = [datadir / session / 'task.bin' for session in pair]
+            if force or not is_up_to_date(path_efficiency_plot_path(pair), task_paths):
+                jobs.append((_plot_path_efficiency_job, pair))
+    else:
+        raise ValueError('kind must be trajectories or path_efficiency')
+    return jobs
+
+def run_pool(jobs, workers=None, initializer=None, on_result=None, keep_failed=True):
+    """ runs jobs, a dict of key -> (function, *arguments), over a process pool. a job that raises is reported and
+    does not stop the others. returns a dict of key -> result (or the exception, with keep_failed) in the order of jobs
+    on_result: called with the key and the result of every job that succeeded, as soon as it finishes """
+    results = {}
+    if len(jobs) == 0:
+        return results
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=initializer) as pool:
+        futures = {pool.submit(*job): key for key, job in jobs.items()}
+        for future in concurrent.futures.as_completed(futures):
+            key = futures[future]
+            try:
+                results[key] = future.result()
+            except Exception as e:
+                results[key] = e
+                print(f'{key}: failed with {e!r}')
+                continue
+            if on_result is not None:
+                on_result(key, results[key])
+    return {key: results[key] for key in jobs if keep_failed or not isinstance(results[key], Exception)}
+
+@profiling.traced('run_batch')
+def run_batch(sessions, kind='trajectories', workers=None, datadir=DATA_DIR, force=False, render_options=None):
+    """ renders the figures of many sessions over a process pool. each worker imports the plotting modules
+    once and then handles many sessions. returns a dict of job argument -> figure path or exception """
+    use_file_backend() # forked workers inherit the backend
+    jobs = {arg: (job, arg, datadir) for job, arg in make_jobs(sessions, kind, datadir, force, render_options)}
+    return run_pool(jobs, workers, use_file_backend, on_result=lambda arg, path: print(f'{arg}: saved {path}'))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sessions', nargs='+', help='session names or glob patterns, e.g. "2024-02-*_H1_CL_*"')
+    parser.add_argument('--kind', choices=['trajectories', 'path_efficiency'], default='trajectories',
+                        help='figure to make. path_efficiency compares consecutive sessions in pairs')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: number of cpus)')
+    parser.add_argument('--datadir', default=str(DATA_DIR), help='folder containing the session folders')
+    parser.add_argument('--force', action='store_true', help='re-render figures that are newer than their task.bin')
+    parser.add_argument('--format', default='pdf', help='file format of the trajectory figures, e.g. pdf or png')
+    parser.add_argument('--rasterized', action='store_true', help='draw the trajectories as a bitmap inside vector formats')
+    parser.add_argument('--downsample', type=int, default=1, help='only draw every downsample-th cursor position')
+    parser.add_argument('--dpi', type=float, default=None, help='resolution of png figures and rasterized trajectories')
+    parser.add_argument('--copilot', choices=['on', 'off'], default=None, help='only sessions with the copilot on or off')
+    parser.add_argument('--target-dia', type=float, default=None, help='only sessions with this target diameter')
+    parser.add_argument('--participant', default=None, help='only sessions of this participant, e.g. H1')
+    profiling.add_argument(parser)
+
+    args = parser.parse_args()
+    profiling.from_args(args) # the worker processes inherit the profiling
+    sessions = find_sessions(args.sessions, args.datadir)
+    copilot = None if args.copilot is None else args.copilot == 'on'
+    sessions = filter_sessions(sessions, args.datadir, copilot, args.target_dia, args.participant)
+    render_options = {'fmt': args.format, 'rasterized': args.rasterized, 'downsample': args.downsample, 'dpi': args.dpi}
+    run_batch(sessions, args.kind, args.workers, args.datadir, args.force, render_options)
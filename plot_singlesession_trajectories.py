@@ -1,30 +1,41 @@
 import numpy as np
 import data_util
-import matplotlib.pyplot as plt
+import trial_util
 import pathlib
 import argparse
 import ast
 import re
+import time
+import profiling
+import session_meta
 
-from plot_util import get_readme, get_target_pos_dia
+from plot_util import DATA_DIR, get_target_pos_dia, add_trajectories
 
 def get_copilot_status(data_path):
     """ returns the copilot status. 1.0: no copilot, 0.0: copilot ON """
-    readme = get_readme(data_path)
-    copilot = float(readme['kfCopilotAlpha (1.0: no copilot)'])
-    return copilot
-
-def plot_trajectories(session):
-    """ plot single session trajectories """
-    datadir = pathlib.Path('/data/raspy/')
-    data_path = datadir / session
+    return session_meta.load_meta(data_path).copilot_alpha
+
+def trajectory_plot_path(session, fmt='pdf'):
+    """ returns the path of the trajectory figure of a session """
+    return pathlib.Path(f'figures/trajectory_plots/{session}.{fmt}')
+
+@profiling.traced('plot_trajectories')
+def plot_trajectories(session, datadir=DATA_DIR, fmt='pdf', rasterized=False, downsample=1, dpi=None):
+    """ plot single session trajectories. returns the path of the saved figure
+    fmt: file format of the figure, e.g. 'pdf' or 'png'
+    rasterized: draw the trajectories as a bitmap inside vector formats, which keeps the pdf small and fast to save
+    downsample: only draw every downsample-th cursor position of the trajectories
+    dpi: resolution of png figures and of the rasterized trajectories (None: matplotlib's default) """
+    import matplotlib.pyplot as plt # only loaded when rendering
+    data_path = pathlib.Path(datadir) / session
 
     # read the target position and diameter from the readme.txt
     positions, target_dia = get_target_pos_dia(data_path)
     # read the task data
     task_data = data_util.load_data(data_path / 'task.bin')
-    state_task = task_data['state_task'].flatten().copy() # tells about the game state i.e. where the target is
-    state_task[task_data['numCompletedBlocks'].flatten() < 0] = 99 # for the starting few calibration trials
+    # state_task tells about the game state i.e. where the target is. start and end indices for trials are the
+    # indices at which the game state changes
+    state_task, start_inds, end_inds, start_targets = trial_util.segment_trials(task_data)
 
 
     # 4 is missing from the state_task. 0,1,2,3,5,6,7,8 left, right, up, down, lu, ld, ru, rd
@@ -33,41 +44,40 @@ def plot_trajectories(session):
     circle_map = {0:0, 1:0, 2:1, 3:1, 4:2, 5:3, 6:3, 7:2}
     colors_map = {0:0, 1:1, 2:2, 3:3, 4:5, 5:6, 6:7, 7:8}
 
-    # start and end indices for trials. reading the index at which the game state changes 
-    start_inds = np.nonzero(state_task[1:None] != state_task[0:-1])[0][1:None] + 1
-    end_inds = np.hstack([start_inds[1:None], [len(state_task)+1]])
-
     # Create single plot with 4 subplots
     fig, axes = plt.subplots(1,4,figsize=(20, 10))
     # Flatten the axes array to iterate over it easily
     axes = axes.flatten()
 
-    for start, end in zip(start_inds, end_inds):
-        xy = task_data['decoded_pos'][start:end]
-        target = state_task[start]
-        if target != 99:
-            c = colors[target]
-            ax = axes[subplot_map[target]]
-            ax.plot(xy[:, 0], xy[:, 1], '.-', c=c, ms=1)
-            ax.set_ylim(-1.1, 1.1)
-            ax.set_xlim(-1.1, 1.1)
-            ax.axis('off')
-
-    for i in range(8):
-        # plt.subplot(2,4,i+1)
+    t0 = time.perf_counter()
+    with profiling.span('plot_trajectories.draw', session=session):
+        # one LineCollection per subplot instead of one line per trial
+        trials = np.nonzero(start_targets != trial_util.CENTER_STATE)[0]
+        targets = start_targets[trials]
+        paths = trial_util.trial_paths(task_data['decoded_pos'], start_inds[trials], end_inds[trials], downsample)
+        for k, ax in enumerate(axes):
+            in_ax = [i for i, target in enumerate(targets) if subplot_map[target] == k]
+            if len(in_ax) > 0:
+                add_trajectories(ax, [paths[i] for i in in_ax], [colors[targets[i]] for i in in_ax], rasterized=rasterized)
+                ax.set_ylim(-1.1, 1.1)
+                ax.set_xlim(-1.1, 1.1)
+                ax.axis('off')
+
+        for i in range(8):
+            # plt.subplot(2,4,i+1)
         
-        circle = plt.Circle(positions[i], target_dia/2.0, color=colors[colors_map[i]], alpha=0.4, zorder=-4)
-        cursor = plt.Circle((0.0, 0.0), 0.05, color='gray', alpha=0.4, zorder=-4)
-        ax = axes[circle_map[i]]
-        # ax = plt.gca()
-        ax.plot([-1, 1, 1, -1, -1], [-1, -1, 1, 1, -1], 'k', alpha = 0.3)
-        ax.add_patch(circle)
-        ax.add_patch(cursor)
-        ax.set_aspect('equal')
-        # Annotate the end points
-        ax.text(-1, -1, '-1', fontsize=10, ha='right', va='top')
-        ax.text(-1, 1, '1', fontsize=10, ha='right', va='bottom')
-        ax.text(1, -1, '1', fontsize=10, ha='left', va='top')
+            circle = plt.Circle(positions[i], target_dia/2.0, color=colors[colors_map[i]], alpha=0.4, zorder=-4)
+            cursor = plt.Circle((0.0, 0.0), 0.05, color='gray', alpha=0.4, zorder=-4)
+            ax = axes[circle_map[i]]
+            # ax = plt.gca()
+            ax.plot([-1, 1, 1, -1, -1], [-1, -1, 1, 1, -1], 'k', alpha = 0.3)
+            ax.add_patch(circle)
+            ax.add_patch(cursor)
+            ax.set_aspect('equal')
+            # Annotate the end points
+            ax.text(-1, -1, '-1', fontsize=10, ha='right', va='top')
+            ax.text(-1, 1, '1', fontsize=10, ha='right', va='bottom')
+            ax.text(1, -1, '1', fontsize=10, ha='left', va='top')
 
     copilot_info = get_copilot_status(data_path) #kfCopilotAlpha (1.0: no copilot)
     copilot = '_copilot_ON' if copilot_info == 0.0 else 'copilot_OFF'
@@ -75,13 +85,26 @@ def plot_trajectories(session):
 
     fig.suptitle(f'{session} {copilot} target dia {target_dia}', fontsize = 16, y= 0.75)
     plt.tight_layout()
-    plt.savefig(f'figures/trajectory_plots/{session}{copilot if copilot == "copilot_ON" else ""}.pdf', bbox_inches='tight')
+    t1 = time.perf_counter()
+    plot_path = trajectory_plot_path(session, fmt)
+    with profiling.span('plot_trajectories.save', session=session):
+        plt.savefig(plot_path, bbox_inches='tight', dpi=dpi)
+    plt.close(fig)
+    t2 = time.perf_counter()
+    print(f'{session}: {len(trials)} trials drawn in {t1-t0:.2f} s, saved in {t2-t1:.2f} s')
+    return plot_path
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('session_name', help='session name to plot the trajectories')
+    parser.add_argument('--format', default='pdf', help='file format of the figure, e.g. pdf or png')
+    parser.add_argument('--rasterized', action='store_true', help='draw the trajectories as a bitmap inside vector formats')
+    parser.add_argument('--downsample', type=int, default=1, help='only draw every downsample-th cursor position')
+    parser.add_argument('--dpi', type=float, default=None, help='resolution of png figures and rasterized trajectories')
+    profiling.add_argument(parser)
 
     args = parser.parse_args()
+    profiling.from_args(args)
     session = args.session_name
-    plot_trajectories(session)
\ No newline at end of file
+    plot_trajectories(session, fmt=args.format, rasterized=args.rasterized, downsample=args.downsample, dpi=args.dpi)
\ No newline at end of file
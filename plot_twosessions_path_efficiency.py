@@ -1,39 +1,24 @@
 import numpy as np
 import data_util
-import matplotlib.pyplot as plt
+import trial_util
+import session_cache
 import pathlib
-import math
 import argparse
+import profiling
 
-from scipy.stats import ttest_ind
-from plot_util import get_target_pos_dia
+from plot_util import DATA_DIR
 
-def get_task_data(session):
+def get_task_data(session, datadir=DATA_DIR):
     """ returns task_data, state_task, start and end indices for a session """
-    datadir = pathlib.Path('/data/raspy/')
-    task_data = data_util.load_data(datadir / session / 'task.bin')
-    state_task = task_data['state_task'].flatten().copy()
-    state_task[task_data['numCompletedBlocks'].flatten() < 0] = 99
-
-    start_inds = np.nonzero(state_task[1:None] != state_task[0:-1])[0][1:None] + 1
-    end_inds = np.hstack([start_inds[1:None], [len(state_task)+1]])
+    task_data = data_util.load_data(pathlib.Path(datadir) / session / 'task.bin')
+    state_task = trial_util.get_state_task(task_data)
+    start_inds, end_inds = trial_util.get_trial_inds(state_task)
 
     return task_data, state_task, start_inds, end_inds
 
-def calculate_distance(x1, y1, x2, y2):
-    """ calculates euclidean distance between two points """
-    return math.sqrt((x2-x1)**2 + (y2-y1)**2)
-
 def total_distance_traveled(positions):
     """ calculates the total distance along a path given by positions """
-    total_distance = 0.0
-
-    for i in range(1, len(positions)):
-        x1, y1 = positions[i-1]
-        x2, y2 = positions[i]
-        total_distance += calculate_distance(x1, y1, x2, y2)
-
-    return total_distance
+    return trial_util.path_lengths(positions, [0], [len(positions)])[0]
 
 def path_efficiency(cursor_positions, target_position):
     """ calculate path efficiency """
@@ -44,33 +29,29 @@ def path_efficiency(cursor_positions, target_position):
 
     return efficiency
 
-def calculate_efficiency_array(session):
-    task_data, state_task, start_inds, end_inds = get_task_data(session)
-
-    # read the target position and diameter from the readme.txt
-    datadir = pathlib.Path('/data/raspy/')
-    data_path = datadir / session
-    positions, _ = get_target_pos_dia(data_path)
-
-    efficiency_array = []
-
-    for start, end in zip(start_inds, end_inds):
-        xy = task_data['decoded_pos'][start:end]
-        target = state_task[start]
-        if target != 99:
-            efficiency = path_efficiency(xy, np.abs(positions[0][0]))
-            efficiency_array.append(efficiency)
+@profiling.traced('calculate_efficiency_array')
+def calculate_efficiency_array(session, datadir=DATA_DIR):
+    # per-trial metrics are cached, so repeat runs do not read the session folder
+    tables = session_cache.load_session_tables(pathlib.Path(datadir) / session)
+    efficiency_array = list(tables['path_efficiency'][tables['target'] != trial_util.CENTER_STATE])
 
     mean_efficiency = np.mean(efficiency_array)
     std_dev_efficiency = np.std(efficiency_array)
 
     return efficiency_array, mean_efficiency, std_dev_efficiency
 
-def plot_path_efficiency(sessions):
-    """ plot path efficieny. currently optimised for comparing two sessions only. """
+def path_efficiency_plot_path(sessions):
+    """ returns the path of the path efficiency figure of two sessions """
+    return pathlib.Path(f'figures/path_efficiency_plots/{sessions[0]}_2_Pathefficiency.pdf')
+
+@profiling.traced('plot_path_efficiency')
+def plot_path_efficiency(sessions, datadir=DATA_DIR):
+    """ plot path efficieny. currently optimised for comparing two sessions only. returns the path of the saved figure """
+    import matplotlib.pyplot as plt # only loaded when rendering
+    from scipy.stats import ttest_ind
     session1, session2 = sessions
-    efficiency_array_session1, mean_efficiency_session1, std_dev_efficiency_session1 = calculate_efficiency_array(session1)
-    efficiency_array_session2, mean_efficiency_session2, std_dev_efficiency_session2 = calculate_efficiency_array(session2)
+    efficiency_array_session1, mean_efficiency_session1, std_dev_efficiency_session1 = calculate_efficiency_array(session1, datadir)
+    efficiency_array_session2, mean_efficiency_session2, std_dev_efficiency_session2 = calculate_efficiency_array(session2, datadir)
 
     t_stat, p_value = ttest_ind(efficiency_array_session1, efficiency_array_session2)
     significant_difference_stars = '*' * (int(-np.log10(p_value)) - 1) if p_value < 0.05 else ''
@@ -97,7 +78,10 @@ def plot_path_efficiency(sessions):
 
     plt.title(f'Path Efficiency Comparison')
     plt.tight_layout()
-    plt.savefig(f'figures/path_efficiency_plots/{session1}_2_Pathefficiency.pdf', bbox_inches='tight')
+    plot_path = path_efficiency_plot_path(sessions)
+    with profiling.span('plot_path_efficiency.save', sessions=list(sessions)):
+        plt.savefig(plot_path, bbox_inches='tight')
+    plt.close(fig)
 
     print(f'\nMean Path Efficiency: {mean_efficiency_session1:.2f}%')
     print(f'Standard Deviation of Path Efficiency: {std_dev_efficiency_session1:.2f}')
@@ -106,12 +90,15 @@ def plot_path_efficiency(sessions):
     print(f'Standard Deviation of Path Efficiency: {std_dev_efficiency_session2:.2f}')
 
     print(f'\np value: {p_value}')
+    return plot_path
     
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('session_names', nargs=2, help='session names to compare the path efficiencies')
+    profiling.add_argument(parser)
 
     args = parser.parse_args()
+    profiling.from_args(args)
     sessions = args.session_names
     plot_path_efficiency(sessions)
\ No newline at end of file
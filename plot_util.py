@@ -1,52 +1,24 @@
-import numpy as np
-import data_util
-import matplotlib.pyplot as plt
 import pathlib
-import argparse
-import ast
-import re
+import profiling
+import session_meta
 
-def get_readme(data_path):
-    """ converts readme.txt into a dictionary """
-
-    readme_file_path = data_path / 'README.txt'
-
-    # Initialize an empty dictionary to store key-value pairs
-    readme_data = {}
-
-    with open(readme_file_path, 'r') as file:
-        lines = file.readlines()
+DATA_DIR = pathlib.Path('/data/raspy/') # folder with one sub-folder per session
 
-    for line in lines:
-        # Split each line into key and value using the ':' as a separator
-        split_result = line.rsplit(':', 1) # doing rsplit instead of split would be a better option
+def add_trajectories(ax, paths, colors, rasterized=False, **kwargs):
+    """ draws the (samples, 2) paths on ax as one LineCollection instead of one Line2D per path, which is much
+    faster to draw and save. colors: one color for all paths or one per path. returns the collection """
+    from matplotlib.collections import LineCollection # only loaded when rendering
+    collection = LineCollection(paths, colors=colors, rasterized=rasterized, **kwargs)
+    ax.add_collection(collection)
+    return collection
 
-        # check if the split result has at least two elements
-        if len(split_result) >= 2:
-            key, value = map(str.strip, split_result)
-            readme_data[key] = value
-
-    return readme_data
+@profiling.traced('plot_util.get_readme')
+def get_readme(data_path):
+    """ converts readme.txt into a dictionary """
+    return dict(session_meta.load_meta(data_path).readme)
 
+@profiling.traced('plot_util.get_target_pos_dia')
 def get_target_pos_dia(data_path):
-    """ extracts target position and diameter from the readme.txt """
-    readme = get_readme(data_path)
-    array = np.array # for eval to work
-    # Extract target_pos and target_size
-    target_pos = eval(readme['Target info'])[0][0]
-    target_dia = eval(readme['Target info'])[1][1]
-
-    if target_pos == -0.7 or target_pos == 0.7:
-        # Define positions for 8 targets
-        positions = [
-            (-0.7, 0),    # Left
-            (0.7, 0),     # Right
-            (0, 0.7),     # Up
-            (0, -0.7),    # Down
-            (-0.495, 0.495),  # LeftUp
-            (-0.495, -0.495), # LeftDown
-            (0.495, 0.495),   # RightUp
-            (0.495, -0.495)   # RightDown
-        ]
-
-    return positions, target_dia
\ No newline at end of file
+    """ extracts target position and diameter from the readme.txt, parsed without eval """
+    meta = session_meta.load_meta(data_path)
+    return meta.target_positions, meta.target_dia
@@ -0,0 +1,199 @@
+import os
+import sys
+import time
+import json
+import atexit
+import functools
+import threading
+
+# Spans record wall time, bytes read and peak memory of the stages of an analysis as chrome trace events
+# ("ph": "X"). When profiling is disabled, span() returns a shared no-op context and traced functions only
+# check a flag, so the instrumentation can stay in the code.
+#
+# Events are appended as json lines to an event file as they end, so worker processes (which inherit the
+# BCI_PROFILE environment variable) write to the same file as the parent. enable('trace.json') converts the
+# events into a chrome trace (chrome://tracing, https://ui.perfetto.dev) at exit, enable('trace.jsonl')
+# keeps the json lines.
+
+ENV_VAR = 'BCI_PROFILE'
+
+_enabled = False
+_events_path = None
+_file = None
+_file_pid = None
+_lock = threading.Lock()
+
+def _bytes_read():
+    # (bytes read from disk, bytes read by read calls) by this process so far, from /proc/self/io. read_bytes only
+    # counts page cache misses (including those of memory maps), so it is 0 for a file that is already cached. rchar
+    # counts every read call, cached or not, but not the pages of memory maps. None where /proc is not available
+    counters = {}
+    try:
+        with open('/proc/self/io', 'rb') as f:
+            for line in f:
+                name, value = line.split(b':')
+                counters[name] = int(value)
+    except (OSError, ValueError):
+        return None
+    return counters.get(b'read_bytes', 0), counters.get(b'rchar', 0)
+
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss/1024.0**2 if sys.platform == 'darwin' else maxrss/1024.0 # bytes on macOS, kB on linux
+
+def _write_event(event):
+    global _file, _file_pid
+    with _lock:
+        if _file is None or _file_pid != os.getpid():
+            # (re)opened after a fork, so that processes do not share a write buffer
+            _file = open(_events_path, 'a')
+            _file_pid = os.getpid()
+        _file.write(json.dumps(event) + '\n')
+        _file.flush()
+    return
+
+class _Span():
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        return
+    def __enter__(self):
+        self.bytes0 = _bytes_read()
+        self.t0 = time.perf_counter()
+        return self
+    def __exit__(self, exc_type, exc, tb):
+        t1 = time.perf_counter()
+        bytes1 = _bytes_read()
+        args = dict(self.args)
+        if bytes1 is not None and self.bytes0 is not None:
+            args['bytes_read'] = bytes1[0] - self.bytes0[0]
+            args['chars_read'] = bytes1[1] - self.bytes0[1]
+        args['peak_rss_mb'] = _peak_rss_mb()
+        if exc_type is not None:
+            args['error'] = exc_type.__name__
+        _write_event({'name': self.name, 'ph': 'X', 'ts': (_epoch + self.t0)*1e6, 'dur': (t1 - self.t0)*1e6,
+                      'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args})
+        return False
+
+class _NullSpan():
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NULL_SPAN = _NullSpan()
+_epoch = time.time() - time.perf_counter() # so that the timestamps of different processes line up
+
+def enabled():
+    return _enabled
+
+def span(name, **args):
+    """ context manager timing a stage. keyword arguments are stored with the event, e.g. the file name """
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+def traced(name=None):
+    """ decorator wrapping every call of the function in a span named name (default: module.function) """
+    def decorator(fn):
+        span_name = name if name is not None else f'{fn.__module__}.{fn.__qualname__}'
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with _Span(span_name, {}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _start(events_path):
+    global _enabled, _events_path
+    _events_path = events_path
+    _enabled = True
+    return
+
+def enable(path):
+    """ starts profiling this process and the processes it starts. path ending in .jsonl gets the events as
+    json lines, any other path gets a chrome trace json written at exit (or by finish) """
+    path = str(path)
+    events_path = path if path.endswith('.jsonl') else path + '.events.jsonl'
+    open(events_path, 'w').close()
+    os.environ[ENV_VAR] = events_path
+    _start(events_path)
+    if not path.endswith('.jsonl'):
+        atexit.register(finish, path)
+    return
+
+def read_events(events_path):
+    events = []
+    with open(events_path, 'r') as f:
+        for line in f:
+            if line.strip():
+                events.append(json.loads(line))
+    return events
+
+def finish(path):
+    """ stops profiling and writes the events recorded so far, by all processes, as a chrome trace to path """
+    global _enabled, _file
+    if not _enabled:
+        return
+    _enabled = False
+    with _lock:
+        if _file is not None:
+            _file.close()
+            _file = None
+    events = read_events(_events_path)
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    os.remove(_events_path)
+    os.environ.pop(ENV_VAR, None)
+    return
+
+def summarize(events):
+    """ count, total and mean wall time (in s) and total bytes read (from disk, and by read calls) of every span name,
+    slowest total first """
+    totals = {}
+    for event in events:
+        total = totals.setdefault(event['name'], {'name': event['name'], 'count': 0, 'seconds': 0.0, 'bytes_read': 0,
+                                                         'chars_read': 0})
+        total['count'] += 1
+        total['seconds'] += event['dur']/1e6
+        total['bytes_read'] += event['args'].get('bytes_read') or 0
+        total['chars_read'] += event['args'].get('chars_read') or 0
+    rows = sorted(totals.values(), key=lambda total: -total['seconds'])
+    for row in rows:
+        row['mean'] = row['seconds']/row['count']
+    return rows
+
+def print_summary(file=None):
+    """ prints the summary of the events recorded so far """
+    if _events_path is None or not os.path.exists(_events_path):
+        return
+    # disk (MB): page cache misses, 0 for cached files. read (MB): all read calls, cached or not
+    print(f'{"span":<48}{"count":>7}{"total (s)":>11}{"mean (ms)":>11}{"disk (MB)":>11}{"read (MB)":>11}', file=file)
+    for row in summarize(read_events(_events_path)):
+        print(f'{row["name"]:<48}{row["count"]:>7}{row["seconds"]:>11.3f}{row["mean"]*1e3:>11.2f}{row["bytes_read"]/2**20:>11.1f}'
+              f'{row["chars_read"]/2**20:>11.1f}', file=file)
+    return
+
+def add_argument(parser):
+    """ adds the --profile switch to an argparse parser """
+    parser.add_argument('--profile', default=None, metavar='PATH',
+                        help='record the time, bytes read and peak memory of every stage into PATH (.json: chrome trace, .jsonl: json lines). '
+                             'bytes_read only counts reads from disk, so it is 0 for files in the page cache; chars_read counts every read call')
+    return
+
+def from_args(args):
+    """ enables profiling if --profile was given, and prints the summary at exit """
+    if getattr(args, 'profile', None) is not None:
+        enable(args.profile)
+        atexit.register(print_summary) # registered last, so it runs before finish removes the event file
+    return
+
+if os.environ.get(ENV_VAR):
+    # a worker process of a profiled run: append to the parent's event file
+    _start(os.environ[ENV_VAR])
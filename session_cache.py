@@ -0,0 +1,120 @@
+import numpy as np
+import data_util
+import trial_util
+import pathlib
+import hashlib
+import json
+import os
+import profiling
+
+from plot_util import get_readme, get_target_pos_dia
+
+CACHE_DIR = pathlib.Path(os.environ.get('BCI_CACHE_DIR', '~/.cache/bci-eeg-data-analysis')).expanduser()
+MAX_BYTES = 2**30 # size bound of the cache directory
+
+def file_key(*paths):
+    """ content key of files from their path, size and modification time """
+    h = hashlib.sha1()
+    for path in paths:
+        stat = os.stat(path)
+        h.update(f'{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}\n'.encode('utf-8'))
+    return h.hexdigest()
+
+class SessionCache():
+    """ directory of .npz entries keyed by file_key, evicting the least recently used entries beyond max_bytes """
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=MAX_BYTES):
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.max_bytes = max_bytes
+        return
+    def _path(self, key):
+        return self.cache_dir / f'{key}.npz'
+    def get(self, key):
+        # returns the dict of arrays stored under key, or None
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as npz:
+                entry = {name: npz[name] for name in npz.files}
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+        try:
+            os.utime(path) # mark as recently used
+        except FileNotFoundError:
+            pass
+        return entry
+    def put(self, key, entry):
+        # stores a dict of arrays under key. concurrent readers never see a partial entry
+        data_util.atomic_write(self._path(key), lambda f: np.savez(f, **entry))
+        self.evict()
+        return
+    def evict(self):
+        # removes the least recently used entries until the cache fits in max_bytes
+        entries = []
+        for path in self.cache_dir.glob('*.npz'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(entry[1] for entry in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+        return
+    def clear(self):
+        for path in self.cache_dir.glob('*.npz'):
+            path.unlink()
+        return
+
+_default_cache = None
+
+def default_cache():
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = SessionCache()
+    return _default_cache
+
+def _encode_json(obj):
+    return np.frombuffer(json.dumps(obj).encode('utf-8'), dtype='uint8')
+
+def _decode_json(arr):
+    return json.loads(arr.tobytes().decode('utf-8'))
+
+@profiling.traced('session_cache.compute_session_tables')
+def compute_session_tables(data_path):
+    """ parses the README.txt and task.bin of a session into the README dict, the trial table and the per-trial metrics """
+    data_path = pathlib.Path(data_path)
+    readme = get_readme(data_path)
+    positions, target_dia = get_target_pos_dia(data_path)
+    task_data = data_util.load_data(data_path / 'task.bin', labels=['state_task', 'numCompletedBlocks', 'decoded_pos'], mmap=True)
+    state_task, start_inds, end_inds, targets = trial_util.segment_trials(task_data)
+    metrics = trial_util.trial_metrics(task_data['decoded_pos'], start_inds, end_inds, targets, np.hypot(*positions[0]))
+    tables = {'readme': readme, 'target_dia': target_dia}
+    tables.update(metrics)
+    return tables
+
+@profiling.traced('session_cache.load_session_tables')
+def load_session_tables(data_path, cache=None):
+    """ compute_session_tables, cached on the path, size and mtime of the session's task.bin and README.txt.
+    on a cache hit the session folder is not read. the returned dict has the keys readme, target_dia and the
+    keys of trial_util.trial_metrics """
+    data_path = pathlib.Path(data_path)
+    if cache is None:
+        cache = default_cache()
+    key = file_key(data_path / 'task.bin', data_path / 'README.txt')
+    entry = cache.get(key)
+    if entry is not None:
+        tables = {name: value for name, value in entry.items() if name not in ('readme', 'target_dia')}
+        tables['readme'] = _decode_json(entry['readme'])
+        tables['target_dia'] = float(entry['target_dia'])
+        return tables
+    tables = compute_session_tables(data_path)
+    entry = {name: value for name, value in tables.items() if name != 'readme'}
+    entry['readme'] = _encode_json(tables['readme'])
+    cache.put(key, entry)
+    return tables
@@ -0,0 +1,212 @@
+import numpy as np
+import data_util
+import pathlib
+import hashlib
+import json
+import ast
+import os
+import re
+
+# positions of the 8 center-out targets at a target distance of 0.7: left, right, up, down, leftup, leftdown, rightup, rightdown
+TARGET_POSITIONS = [(-0.7, 0), (0.7, 0), (0, 0.7), (0, -0.7), (-0.495, 0.495), (-0.495, -0.495), (0.495, 0.495), (0.495, -0.495)]
+COPILOT_KEY = 'kfCopilotAlpha (1.0: no copilot)'
+
+_ARRAY_FUNCTIONS = ('array', 'np.array', 'numpy.array')
+_NAMES = {'nan': np.nan, 'inf': np.inf, 'True': True, 'False': False, 'None': None}
+
+def _dotted_name(node):
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        return _dotted_name(node.value) + '.' + node.attr
+    raise ValueError(f'unsupported expression {ast.unparse(node)!r}')
+
+def _literal(node):
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float, complex, str, bool, type(None))):
+        return node.value
+    if isinstance(node, ast.Tuple):
+        return tuple(_literal(element) for element in node.elts)
+    if isinstance(node, ast.List):
+        return [_literal(element) for element in node.elts]
+    if isinstance(node, ast.Dict):
+        return {_literal(key): _literal(value) for key, value in zip(node.keys, node.values)}
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        value = _literal(node.operand)
+        if isinstance(value, (int, float, complex)) and not isinstance(value, bool):
+            return -value if isinstance(node.op, ast.USub) else value
+    if isinstance(node, ast.Name) and node.id in _NAMES:
+        return _NAMES[node.id]
+    if isinstance(node, ast.Call) and _dotted_name(node.func) in _ARRAY_FUNCTIONS:
+        kwargs = {}
+        for keyword in node.keywords:
+            if keyword.arg != 'dtype':
+                raise ValueError(f'unsupported argument {keyword.arg} of array')
+            # numpy's repr writes the dtype as a bare name, e.g. dtype=float32
+            kwargs['dtype'] = keyword.value.id if isinstance(keyword.value, ast.Name) else _literal(keyword.value)
+        return np.array(*[_literal(arg) for arg in node.args], **kwargs)
+    raise ValueError(f'unsupported expression {ast.unparse(node)!r}')
+
+def parse_literal(text):
+    """ parses python literals (numbers, strings, tuples, lists, dicts, nan, inf) and numpy array(...) calls, as
+    written into README.txt by the recording software, without evaluating any code. raises ValueError otherwise """
+    try:
+        tree = ast.parse(text.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ValueError(f'cannot parse {text!r}') from e
+    return _literal(tree.body)
+
+def read_readme(readme_path):
+    """ converts readme.txt into a dictionary of strings, one entry per 'key: value' line """
+    readme_data = {}
+    with open(readme_path, 'r') as file:
+        lines = file.readlines()
+    for line in lines:
+        # split at the last ':' as keys can contain ':', e.g. kfCopilotAlpha (1.0: no copilot)
+        split_result = line.rsplit(':', 1)
+        if len(split_result) >= 2:
+            key, value = map(str.strip, split_result)
+            readme_data[key] = value
+    return readme_data
+
+def parse_session_name(session):
+    """ date and participant of a session named like 2024-01-15_H1_CL_2. None where the name does not match """
+    match = re.match(r'^(\d{4}-\d{2}-\d{2})_([A-Za-z]+\d*)', session)
+    if match is None:
+        return None, None
+    return match.group(1), match.group(2)
+
+class SessionMeta():
+    """ metadata of a session from its folder name and README.txt """
+    def __init__(self, session, readme):
+        # session: name of the session folder
+        # readme: dict of the README.txt entries, as strings
+        self.session = session
+        self.readme = readme
+        self.date, self.participant = parse_session_name(session)
+        self._target_info = None
+        self.copilot_alpha = float(readme[COPILOT_KEY]) if COPILOT_KEY in readme else None
+        return
+
+    @property
+    def target_info(self):
+        # parsed on first use, so that a session with a malformed entry can still be indexed
+        if self._target_info is None:
+            self._target_info = parse_literal(self.readme['Target info'])
+        return self._target_info
+
+    @property
+    def target_distance(self):
+        # distance of the targets from the center, from the position of the first target
+        distance = float(np.hypot(*np.asarray(self.target_info[0], dtype='float64')[0:2]))
+        if not distance > 0:
+            raise ValueError(f'target info {self.readme["Target info"]!r} has no target away from the center')
+        return distance
+
+    @property
+    def target_dia(self):
+        return float(self.target_info[1][1])
+
+    @property
+    def target_positions(self):
+        # positions of the 8 targets, in the order of state_task 0, 1, 2, 3, 5, 6, 7, 8
+        scale = self.target_distance/0.7
+        return [(x*scale, y*scale) for x, y in TARGET_POSITIONS]
+
+    @property
+    def copilot(self):
+        # whether the copilot was on (kfCopilotAlpha 0.0) or off (1.0). None if not recorded
+        if self.copilot_alpha is None:
+            return None
+        return self.copilot_alpha == 0.0
+
+    def to_dict(self):
+        return {'session': self.session, 'readme': self.readme}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['session'], d['readme'])
+
+    def matches(self, **criteria):
+        """ whether every attribute given as a keyword equals its value (or, for a callable, the callable returns True).
+        floats are compared with np.isclose, e.g. meta.matches(copilot=True, target_dia=0.4, participant='H1') """
+        for name, wanted in criteria.items():
+            value = getattr(self, name)
+            if callable(wanted):
+                if not wanted(value):
+                    return False
+            elif isinstance(wanted, float) and value is not None and not isinstance(value, bool):
+                if not np.isclose(value, wanted):
+                    return False
+            elif value != wanted:
+                return False
+        return True
+
+def _stat_key(path):
+    stat = os.stat(path)
+    return f'{stat.st_size}|{stat.st_mtime_ns}'
+
+_metas = {}
+
+def load_meta(data_path):
+    """ SessionMeta of the session folder data_path. README.txt is parsed once per process and again only when it changes """
+    data_path = pathlib.Path(data_path)
+    readme_path = data_path / 'README.txt'
+    key = _stat_key(readme_path)
+    cached = _metas.get(str(readme_path.absolute()))
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    meta = SessionMeta(data_path.name, read_readme(readme_path))
+    _metas[str(readme_path.absolute())] = (key, meta)
+    return meta
+
+def _index_path(datadir):
+    from session_cache import CACHE_DIR # not at import, as session_cache imports plot_util, which imports this module
+    key = hashlib.sha1(str(pathlib.Path(datadir).absolute()).encode('utf-8')).hexdigest()
+    return CACHE_DIR / f'session_index_{key}.json'
+
+def load_index(datadir=None, refresh=True, index_path=None):
+    """ dict of session name -> SessionMeta of every session folder in datadir with a README.txt.
+    the index is stored in the cache folder. with refresh, new sessions are added and only the READMEs that changed
+    since the last run are parsed again. without refresh, the stored index is returned and no session folder is read """
+    if datadir is None:
+        from plot_util import DATA_DIR
+        datadir = DATA_DIR
+    datadir = pathlib.Path(datadir)
+    index_path = _index_path(datadir) if index_path is None else pathlib.Path(index_path)
+    try:
+        with open(index_path, 'r') as f:
+            stored = json.load(f)
+    except (OSError, ValueError):
+        stored = {}
+    if refresh:
+        entries = {}
+        for readme_path in sorted(datadir.glob('*/README.txt')):
+            session = readme_path.parent.name
+            key = _stat_key(readme_path)
+            if session in stored and stored[session]['key'] == key:
+                entries[session] = stored[session]
+            else:
+                entries[session] = {'key': key, 'meta': SessionMeta(session, read_readme(readme_path)).to_dict()}
+        if entries != stored:
+            try:
+                data_util.atomic_write(index_path, lambda f: json.dump(entries, f), mode='w')
+            except OSError:
+                pass # without write access the changed READMEs are parsed again on every run
+        stored = entries
+    return {session: SessionMeta.from_dict(entry['meta']) for session, entry in stored.items()}
+
+def select_sessions(index, sessions=None, **criteria):
+    """ names of the sessions in the index (or in sessions, in that order) whose metadata matches the criteria of
+    SessionMeta.matches. sessions that are not in the index are dropped """
+    if sessions is None:
+        sessions = sorted(index)
+    selected = []
+    for session in sessions:
+        meta = index.get(session)
+        if meta is not None:
+            try:
+                if meta.matches(**criteria):
+                    selected.append(session)
+            except (KeyError, ValueError, TypeError, IndexError):
+                pass # READMEs without the entry do not match
+    return selected
@@ -0,0 +1,182 @@
+import numpy as np
+import data_util
+import os
+import sys
+import time
+import fcntl
+
+from multiprocessing import shared_memory, resource_tracker
+
+# A SessionServer reads the records of a .bin file once into a shared memory segment. Worker processes attach
+# with the picklable handle and get the same data dict as load_data, with the per-label arrays as views into the
+# segment, so the data is held in memory once however many workers use it.
+#
+# The segment starts with MAX_REFS pid slots. attach() takes a slot and detach() frees it; slots of processes
+# that died without detaching are treated as free, so a crashed worker never keeps the segment alive. The
+# server unlinks the segment on close() once no live process is attached (or at exit). If the server itself
+# crashes, python's resource tracker unlinks the segment.
+
+MAX_REFS = 256
+HEADER_BYTES = MAX_REFS*8
+
+class SharedSessionHandle():
+    """ picklable description of a hosted session: segment name, the header of the file and the number of rows """
+    def __init__(self, shm_name, filename, name, labels, dtypes, dtype, nrows):
+        self.shm_name = shm_name
+        self.filename = filename
+        self.name = name
+        self.labels = labels
+        self.dtypes = dtypes
+        self.dtype = dtype
+        self.nrows = nrows
+        return
+
+def _pid_alive(pid):
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True # exists, owned by another user
+    return True
+
+class _RefTable():
+    # the pid slots at the start of the segment, changed under an flock of the segment itself, so that no lock
+    # file is left behind. every process has its own descriptor of the segment, so the lock works between them.
+    def __init__(self, shm):
+        self.pids = np.ndarray((MAX_REFS,), dtype='int64', buffer=shm.buf)
+        self.fd = shm._fd
+        return
+    def _locked(self, fn):
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            return fn()
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+    def acquire(self, pid):
+        def take():
+            for i in range(MAX_REFS):
+                if self.pids[i] == 0 or not _pid_alive(self.pids[i]):
+                    self.pids[i] = pid
+                    return i
+            raise ValueError(f'more than {MAX_REFS} processes attached')
+        return self._locked(take)
+    def release(self, slot):
+        def free():
+            self.pids[slot] = 0
+        self._locked(free)
+        return
+    def live(self):
+        return [int(pid) for pid in self.pids if pid != 0 and _pid_alive(pid)]
+
+def _open_untracked(shm_name):
+    # attaching must not register the segment with the resource tracker, which the workers share with the server:
+    # the tracker would unlink it when a worker exits, and unregistering afterwards drops the server's registration
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=shm_name, track=False)
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None if rtype == 'shared_memory' else register(name, rtype)
+    try:
+        return shared_memory.SharedMemory(name=shm_name)
+    finally:
+        resource_tracker.register = register
+
+def _data_dict(handle, buf, labels=None):
+    records = np.ndarray((handle.nrows,), dtype=handle.dtype, buffer=buf, offset=HEADER_BYTES)
+    if labels is None:
+        labels = handle.labels
+    else:
+        labels = list(labels)
+        for label in labels:
+            if label not in handle.labels:
+                raise ValueError('label {} not in {}'.format(label, handle.filename))
+    data_dict = {label: records[label] for label in labels}
+    data_dict['name'] = handle.name
+    data_dict['labels'] = labels
+    data_dict['dtypes'] = [handle.dtypes[handle.labels.index(label)] for label in labels]
+    return records, data_dict
+
+class SessionServer():
+    """ hosts the records [start, end) of a .bin file in shared memory. use as a context manager, or call close() """
+    def __init__(self, filename, start=None, end=None):
+        name, labels, dtypes, dtype, offset = data_util.read_header(filename)
+        nrows = (os.path.getsize(filename) - offset)//dtype.itemsize
+        start, end, step = slice(start, end).indices(nrows)
+        end = max(start, end)
+        self.shm = shared_memory.SharedMemory(create=True, size=HEADER_BYTES + max((end-start)*dtype.itemsize, 1))
+        self.handle = SharedSessionHandle(self.shm.name, str(filename), name, labels, dtypes, dtype, end-start)
+        self.refs = _RefTable(self.shm)
+        self.refs.pids[:] = 0
+        records, self.data = _data_dict(self.handle, self.shm.buf)
+        # read straight into the segment, without an intermediate array
+        view = records.view('uint8')
+        with open(filename, 'rb') as f:
+            f.seek(offset + start*dtype.itemsize)
+            done = 0
+            while done < len(view):
+                n = f.readinto(view[done:None])
+                if n == 0:
+                    raise ValueError('{} ended early'.format(filename))
+                done += n
+        return
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+    def attached(self):
+        """ pids of the live processes attached to the session """
+        return self.refs.live()
+    def close(self, timeout=None):
+        """ waits until no live process is attached (at most timeout seconds, None waits forever) and frees the segment.
+        processes still attached after the timeout keep their mapping until they detach or exit """
+        if self.shm is None:
+            return
+        t0 = time.monotonic()
+        while len(self.attached()) > 0 and (timeout is None or time.monotonic() - t0 < timeout):
+            time.sleep(0.01)
+        self.data = None
+        self.refs = None
+        try:
+            self.shm.close()
+        except BufferError:
+            pass # views into the segment are still referenced; the mapping is freed with them
+        self.shm.unlink()
+        self.shm = None
+        return
+    def __del__(self):
+        if getattr(self, 'shm', None) is not None:
+            self.close(timeout=0)
+
+class SharedSession():
+    """ a worker's attachment to a hosted session. data is the dict of per-label views, like load_data """
+    def __init__(self, handle, labels=None):
+        self.handle = handle
+        self.shm = _open_untracked(handle.shm_name)
+        self.refs = _RefTable(self.shm)
+        self.slot = self.refs.acquire(os.getpid())
+        records, self.data = _data_dict(handle, self.shm.buf, labels)
+        return
+    def __enter__(self):
+        return self.data
+    def __exit__(self, exc_type, exc, tb):
+        self.detach()
+        return False
+    def detach(self):
+        """ releases the attachment. the arrays of data must not be used afterwards """
+        if self.shm is None:
+            return
+        self.refs.release(self.slot)
+        self.data = None
+        self.refs = None
+        try:
+            self.shm.close()
+        except BufferError:
+            pass # views into the segment are still referenced; the mapping is freed with them
+        self.shm = None
+        return
+
+def attach(handle, labels=None):
+    """ attaches to a session hosted by a SessionServer. use as a context manager for the data dict:
+    with attach(handle) as data: ... """
+    return SharedSession(handle, labels)
@@ -0,0 +1,117 @@
+import numpy as np
+import pathlib
+import argparse
+
+from trial_util import CENTER_STATE
+
+# state_task of the 8 center-out targets and their positions, in the order of plot_util.get_target_pos_dia
+TARGET_STATES = [0, 1, 2, 3, 5, 6, 7, 8]
+TARGET_POSITIONS = [(-0.7, 0), (0.7, 0), (0, 0.7), (0, -0.7), (-0.495, 0.495), (-0.495, -0.495), (0.495, 0.495), (0.495, -0.495)]
+
+TASK_DTYPE = np.dtype([('time_ns', '<i8', ()), ('state_task', '|i1', (1,)), ('numCompletedBlocks', '<i4', (1,)),
+                       ('decoded_pos', '<f4', (2,))])
+
+def header(name, dtype):
+    """ the three-line text header of a .bin file holding records of the structured dtype, as written by data_util.resave_data """
+    dtypes_str = ','.join([dtype[i].base.str for i in range(len(dtype))]) + '$' + ','.join([str(dtype[i].shape) for i in range(len(dtype))])
+    return (name + '\n' + ','.join(dtype.names) + '\n' + dtypes_str + '\n').encode('utf-8')
+
+def make_task(duration=300.0, fs=50.0, calibration_trials=2, trials_per_block=8, seed=0):
+    """ structured array of a center-out session: trials to a random target, each followed by a return to the center
+    (state_task 99). the first calibration_trials target trials have numCompletedBlocks = -1 """
+    rng = np.random.default_rng(seed)
+    n = int(duration*fs)
+    segments = []
+    count = 0
+    trial = 0
+    while count < n:
+        state = TARGET_STATES[rng.integers(len(TARGET_STATES))]
+        goal = np.array(TARGET_POSITIONS[TARGET_STATES.index(state)])
+        block = -1 if trial < calibration_trials else (trial - calibration_trials)//trials_per_block
+        for target, start_pos, end_pos in [(state, np.zeros(2), goal), (CENTER_STATE, goal, np.zeros(2))]:
+            length = max(2, int(rng.uniform(1.0, 3.0)*fs))
+            s = np.linspace(0.0, 1.0, length)
+            profile = 10*s**3 - 15*s**4 + 6*s**5 # minimum-jerk reach
+            wobble = np.cumsum(rng.standard_normal((length, 2)), axis=0)*0.01*np.sin(np.pi*s)[:, None]
+            segments.append((target, block, start_pos + profile[:, None]*(end_pos - start_pos) + wobble))
+            count += length
+        trial += 1
+    data = np.zeros(count, dtype=TASK_DTYPE)
+    i = 0
+    for target, block, pos in segments:
+        data['state_task'][i:i+len(pos)] = target
+        data['numCompletedBlocks'][i:i+len(pos)] = block
+        data['decoded_pos'][i:i+len(pos)] = pos
+        i += len(pos)
+    data = data[0:n]
+    data['time_ns'] = (np.arange(n)*1e9/fs).astype('int64')
+    return data
+
+def eeg_dtype(channels):
+    return np.dtype([('time_ns', '<i8', ()), ('eeg', '<f4', (channels,))])
+
+def make_eeg(start, end, channels=64, fs=1000.0, seed=0):
+    """ rows [start, end) of a synthetic eeg recording: 1/f background, a 10 Hz mu rhythm, 60 Hz line noise and
+    slow drift, in microvolts. any range of rows can be generated on its own, so files are written in chunks """
+    rng = np.random.default_rng([seed, start])
+    data = np.zeros(end-start, dtype=eeg_dtype(channels))
+    t = np.arange(start, end)/fs
+    data['time_ns'] = np.arange(start, end)*int(1e9/fs)
+    freqs = np.array([0.1, 1.0, 2.0, 3.0, 5.0, 8.0, 13.0, 20.0, 30.0, 10.0, 60.0])
+    amps = np.hstack([20.0/np.maximum(freqs[0:9], 1.0), [8.0, 3.0]]) # 1/f background, mu rhythm, line noise
+    phases = np.random.default_rng(seed).uniform(0, 2*np.pi, (len(freqs), channels)) # fixed per session, continuous across chunks
+    eeg = rng.standard_normal((end-start, channels))*5.0
+    for f, a, phase in zip(freqs, amps, phases):
+        eeg += a*np.sin(2*np.pi*f*t[:, None] + phase)
+    data['eeg'] = eeg
+    return data
+
+def write_session(session_dir, duration=300.0, channels=64, fs=1000.0, task_fs=50.0, target_dia=0.4, copilot_alpha=1.0,
+                  seed=0, chunk_rows=65536):
+    """ writes task.bin, eeg.bin and README.txt of a synthetic session into session_dir, in the formats read by
+    data_util.load_data and plot_util.get_readme. eeg.bin is written chunk_rows at a time. returns session_dir """
+    session_dir = pathlib.Path(session_dir)
+    session_dir.mkdir(parents=True, exist_ok=True)
+    with open(session_dir / 'task.bin', 'wb') as f:
+        f.write(header('task', TASK_DTYPE))
+        make_task(duration, task_fs, seed=seed).tofile(f)
+    rows = int(duration*fs)
+    with open(session_dir / 'eeg.bin', 'wb') as f:
+        f.write(header('eeg', eeg_dtype(channels)))
+        for start in range(0, rows, chunk_rows):
+            make_eeg(start, min(start + chunk_rows, rows), channels, fs, seed).tofile(f)
+    target_info = f'[array([{TARGET_POSITIONS[0][0]}, {TARGET_POSITIONS[0][1]}]), array([{target_dia}, {target_dia}])]'
+    readme = [
+        f'Session name: {session_dir.name}',
+        f'Duration (s): {duration}',
+        f'EEG sampling rate (Hz): {fs}',
+        f'EEG channels: {channels}',
+        f'Task sampling rate (Hz): {task_fs}',
+        f'Target info: {target_info}',
+        f'kfCopilotAlpha (1.0: no copilot): {copilot_alpha}',
+    ]
+    with open(session_dir / 'README.txt', 'w') as f:
+        f.write('\n'.join(readme) + '\n')
+    return session_dir
+
+def write_archive(datadir, sessions=4, participants=('H1', 'H2'), duration=300.0, channels=64, seed=0, **kwargs):
+    """ writes sessions synthetic sessions named like the recorded ones (2024-01-15_H1_CL_1, ...) into datadir,
+    alternating the participants and the copilot. returns the session names """
+    names = []
+    for i in range(sessions):
+        name = f'2024-01-{15+i//len(participants):02d}_{participants[i % len(participants)]}_CL_{1+i//len(participants)}'
+        write_session(pathlib.Path(datadir) / name, duration, channels, copilot_alpha=float(i % 2 == 0), seed=seed+i, **kwargs)
+        names.append(name)
+    return names
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('datadir', help='folder to write the session folders into')
+    parser.add_argument('--sessions', type=int, default=4, help='number of sessions')
+    parser.add_argument('--duration', type=float, default=300.0, help='duration of every session in seconds')
+    parser.add_argument('--channels', type=int, default=64, help='number of eeg channels')
+    parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+    for name in write_archive(args.datadir, args.sessions, duration=args.duration, channels=args.channels, seed=args.seed):
+        print(name)
@@ -0,0 +1,174 @@
+import numpy as np
+import pathlib
+import hashlib
+import json
+
+electrode_names = ['Fp1', 'Fpz', 'Fp2',
+                  'F7', 'F3', 'Fz', 'F4', 'F8',
+                  'FC5', 'FC1', 'FC2', 'FC6',
+                  'M1', 'T7', 'C3', 'Cz', 'C4', 'T8', 'M2',
+                  'CP5', 'CP1', 'CP2', 'CP6',
+                  'P7', 'P3', 'Pz', 'P4', 'P8', 'POz',
+                  'O1', 'O2', 'EOG',
+                  'AF7', 'AF3', 'AF4', 'AF8',
+                  'F5', 'F1', 'F2', 'F6',
+                  'FC3', 'FCz', 'FC4',
+                  'C5', 'C1', 'C2', 'C6',
+                  'CP3', 'CP4',
+                  'P5', 'P1', 'P2', 'P6',
+                  'PO5', 'PO3', 'PO4', 'PO6',
+                  'FT7', 'FT8', 'TP7', 'TP8',
+                  'PO7', 'PO8', 'Oz']
+
+# grid position (column, row) of every electrode of the 64-channel cap
+inds_original = np.array([
+    [0, 4], [0, 5], [0, 6], [2, 1], [2, 3], [2, 5], [2, 7], [2, 9],
+    [3, 2], [3, 4], [3, 6], [3, 8], [4, 0], [4, 1], [4, 3], [4, 5], [4, 7], [4, 9], [4, 10],
+    [5, 2], [5, 4], [5, 6], [5, 8], [6, 1], [6, 3], [6, 5], [6, 7], [6, 9],
+    [7, 5], [8, 4], [8, 6], [0, 0], [1, 1], [1, 3], [1, 7], [1, 9],
+    [2, 2], [2, 4], [2, 6], [2, 8], [3, 3], [3, 5], [3, 7],
+    [4, 2], [4, 4], [4, 6], [4, 8], [5, 3], [5, 7],
+    [6, 2], [6, 4], [6, 6], [6, 8],
+    [7, 2], [7, 3], [7, 7], [7, 8],
+    [3, 1], [3, 9], [5, 1], [5, 9], [7, 1], [7, 9], [8, 5]
+])
+GRIDSHAPE = (11, 9)
+
+class Montage():
+    """ electrode layout on a grid, with the grid neighbors of every electrode as sparse adjacency matrices """
+    def __init__(self, names, positions, grid_shape=None, cache_dir=None):
+        # names: electrode names, in channel order
+        # positions: (column, row) grid position of every electrode
+        # grid_shape: (rows, columns) of the grid. None fits the grid to the positions.
+        # cache_dir: folder to cache the neighbor tables in, e.g. session_cache.CACHE_DIR. None builds them in memory.
+        self.names = list(names)
+        self.positions = np.asarray(positions, dtype='int')
+        if grid_shape is None:
+            grid_shape = (int(self.positions[:, 1].max())+1, int(self.positions[:, 0].max())+1)
+        self.grid_shape = tuple(grid_shape)
+        self.key = hashlib.sha1(json.dumps([self.names, self.positions.tolist(), self.grid_shape]).encode('utf-8')).hexdigest()
+
+        tables = self._load(cache_dir)
+        if tables is None:
+            tables = self._build()
+            self._save(cache_dir, tables)
+        self.inds_grid = tables['inds_grid'] # electrode index at every grid point, nan where there is none
+        self._neighbor_tables = {1: tables['neighbors_1'], 2: tables['neighbors_2']}
+        self._adjacency = {}
+        return
+
+    @classmethod
+    def from_table(cls, table, grid_shape=None, cache_dir=None):
+        """ montage from a table of (name, (column, row)) rows """
+        names = [row[0] for row in table]
+        positions = [row[1] for row in table]
+        return cls(names, positions, grid_shape, cache_dir)
+
+    def __len__(self):
+        return len(self.names)
+
+    def _build(self):
+        inds_grid = np.full(self.grid_shape, np.nan)
+        inds_grid[self.positions[:, 1], self.positions[:, 0]] = np.arange(len(self.names))
+        return {'inds_grid': inds_grid, 'neighbors_1': self._neighbor_table(inds_grid, 1),
+                'neighbors_2': self._neighbor_table(inds_grid, 2)}
+
+    def _neighbor_table(self, inds_grid, distance):
+        # (channels, 4) indices of the electrodes distance grid steps up, down, left and right, -1 where there is none
+        col, row = self.positions[:, 0], self.positions[:, 1]
+        table = np.full((len(self.names), 4), -1)
+        for j, (drow, dcol) in enumerate([(-distance, 0), (distance, 0), (0, -distance), (0, distance)]):
+            r, c = row + drow, col + dcol
+            inside = (r >= 0)*(r < self.grid_shape[0])*(c >= 0)*(c < self.grid_shape[1])
+            found = np.full(len(self.names), np.nan)
+            found[inside] = inds_grid[r[inside], c[inside]]
+            table[~np.isnan(found), j] = found[~np.isnan(found)]
+        return table
+
+    def _cache_path(self, cache_dir):
+        if cache_dir is None or cache_dir is False:
+            return None
+        return pathlib.Path(cache_dir) / f'montage_{self.key}.npz'
+
+    def _load(self, cache_dir):
+        path = self._cache_path(cache_dir)
+        if path is None or not path.exists():
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as npz:
+                return {name: npz[name] for name in npz.files}
+        except (OSError, ValueError):
+            return None
+
+    def _save(self, cache_dir, tables):
+        path = self._cache_path(cache_dir)
+        if path is None:
+            return
+        import data_util # not at import, as data_util imports this module
+        try:
+            data_util.atomic_write(path, lambda f: np.savez(f, **tables))
+        except OSError:
+            pass # a read-only cache folder: the tables are built again by the next process
+        return
+
+    def neighbors(self, distance=1):
+        """ list of the neighbor indices of every electrode at exactly distance grid steps along a grid axis """
+        return [[int(i) for i in row if i >= 0] for row in self._neighbor_tables[distance]]
+
+    def adjacency(self, distance=1):
+        """ csr matrix with a 1 at [i, j] if electrode j is distance grid steps from electrode i along a grid axis """
+        if distance not in self._adjacency:
+            import scipy.sparse
+            table = self._neighbor_tables[distance]
+            rows, cols = np.nonzero(table >= 0)
+            self._adjacency[distance] = scipy.sparse.csr_matrix(
+                (np.ones(len(rows)), (rows, table[rows, cols])), shape=(len(self), len(self)))
+        return self._adjacency[distance]
+
+    def k_hop(self, k, include_self=False):
+        """ csr matrix with a 1 at [i, j] if electrode j is reachable from electrode i in 1 to k neighbor steps """
+        import scipy.sparse
+        step = self.adjacency(1) + scipy.sparse.identity(len(self), format='csr')
+        reach = scipy.sparse.identity(len(self), format='csr')
+        for i in range(k):
+            reach = reach @ step
+        reach = (reach > 0).astype('float64')
+        if not include_self:
+            reach.setdiag(0)
+            reach.eliminate_zeros()
+        return reach.tocsr()
+
+    def laplacian(self, k=1):
+        """ csr surface Laplacian: every channel minus the mean of its neighbors within k hops """
+        import scipy.sparse
+        neighborhood = self.adjacency(1) if k == 1 else self.k_hop(k)
+        degree = np.asarray(neighborhood.sum(axis=1)).flatten()
+        weights = scipy.sparse.diags(np.divide(1.0, degree, out=np.zeros(len(self)), where=degree > 0))
+        return (scipy.sparse.identity(len(self), format='csr') - weights @ neighborhood).tocsr()
+
+    def common_average(self, reference=None):
+        """ csr common average reference: every channel minus the mean of the reference channels
+        (names or indices, None for all) """
+        import scipy.sparse
+        if reference is None:
+            reference = np.arange(len(self))
+        reference = np.array([self.names.index(r) if isinstance(r, str) else r for r in reference], dtype='int')
+        average = scipy.sparse.csr_matrix((np.full(len(self)*len(reference), 1.0/len(reference)),
+                                           (np.repeat(np.arange(len(self)), len(reference)), np.tile(reference, len(self)))),
+                                          shape=(len(self), len(self)))
+        return (scipy.sparse.identity(len(self), format='csr') - average).tocsr()
+
+def apply_spatial_filter(spatial_filter, data):
+    """ applies a (channels, channels) spatial filter matrix to data of shape (time, channels) as one mat-mul """
+    return np.asarray((spatial_filter @ np.asarray(data).T).T)
+
+_montages = {}
+
+def get_montage(names=None, positions=None, grid_shape=None, cache_dir=None):
+    """ montage built once per process, and cached on disk in cache_dir if given. None uses the 64-channel cap """
+    if names is None:
+        names, positions, grid_shape = electrode_names, inds_original, GRIDSHAPE
+    key = json.dumps([list(names), np.asarray(positions).tolist(), grid_shape])
+    if key not in _montages:
+        _montages[key] = Montage(names, positions, grid_shape, cache_dir)
+    return _montages[key]
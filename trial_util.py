@@ -0,0 +1,93 @@
+import numpy as np
+import profiling
+
+CENTER_STATE = 99 # state_task of the center target, also used to mark the calibration trials
+
+def get_state_task(task_data):
+    """ returns state_task as a flat array with the starting calibration trials (numCompletedBlocks < 0) set to 99 """
+    state_task = task_data['state_task'].flatten().copy() # tells about the game state i.e. where the target is
+    state_task[task_data['numCompletedBlocks'].flatten() < 0] = CENTER_STATE
+    return state_task
+
+def get_trial_inds(state_task):
+    """ start and end indices of the trials, i.e. of the runs of constant state_task.
+    the run at the start of the recording is dropped and the last trial ends at len(state_task)+1 """
+    # reading the index at which the game state changes
+    start_inds = np.nonzero(state_task[1:None] != state_task[0:-1])[0][1:None] + 1
+    end_inds = np.hstack([start_inds[1:None], [len(state_task)+1]]).astype(start_inds.dtype)
+    return start_inds, end_inds
+
+def get_center_out_trial_inds(state_task):
+    """ start and end indices of the center-out trials, i.e. of the runs of state_task that leave the center
+    target (99) and return to it. only trials that end are kept """
+    state_task = np.asarray(state_task).flatten()
+    trial_start_inds = np.nonzero((state_task[0:-1] == CENTER_STATE)*(state_task[1:None] != CENTER_STATE))[0] + 1
+    trial_end_inds = np.nonzero((state_task[0:-1] != CENTER_STATE)*(state_task[1:None] == CENTER_STATE))[0] + 1 # first index back at the center
+    if len(trial_start_inds) > 0 and len(trial_end_inds) > 0 and trial_end_inds[0] < trial_start_inds[0]:
+        # the recording starts inside a trial
+        trial_end_inds = trial_end_inds[1:None]
+    trial_start_inds = trial_start_inds[0:len(trial_end_inds)] # only use trials that end.
+    return trial_start_inds, trial_end_inds
+
+@profiling.traced('trial_util.segment_trials')
+def segment_trials(task_data):
+    """ returns state_task, start and end indices and the target (state_task at the start) of every trial """
+    state_task = get_state_task(task_data)
+    start_inds, end_inds = get_trial_inds(state_task)
+    return state_task, start_inds, end_inds, state_task[start_inds]
+
+def path_lengths(pos, start_inds, end_inds):
+    """ length of the path pos[start:end] (pos of shape (time, 2)) of every trial, in one pass over pos """
+    pos = np.asarray(pos, dtype='float64')
+    starts = np.asarray(start_inds)
+    lasts = np.minimum(end_inds, len(pos)) - 1 # index of the last sample of each trial
+    if len(starts) == 0 or len(pos) == 0:
+        return np.zeros(len(starts))
+    step = np.zeros(len(pos)) # step[i]: distance from pos[i] to pos[i+1]
+    step[0:-1] = np.hypot(*np.diff(pos, axis=0).T)
+    # reduceat over [start, last) pairs sums the steps inside each trial
+    sums = np.add.reduceat(step, np.stack([starts, lasts], axis=1).ravel())[0::2]
+    sums[lasts <= starts] = 0.0 # reduceat returns step[start] for empty ranges
+    return sums
+
+def trial_paths(pos, start_inds, end_inds, downsample=1):
+    """ list of the (samples, 2) paths pos[start:end] of every trial, as views. with downsample > 1 every
+    downsample-th sample is kept, plus the last sample so the paths still end where the trials end """
+    paths = []
+    for start, end in zip(start_inds, end_inds):
+        path = pos[start:end]
+        if downsample > 1 and len(path) > 1:
+            last = path[-1:None]
+            path = path[0:-1:downsample]
+            path = np.concatenate([path, last], axis=0)
+        paths.append(path)
+    return paths
+
+@profiling.traced('trial_util.trial_metrics')
+def trial_metrics(pos, start_inds, end_inds, targets, target_distance, times=None):
+    """ per-trial metrics of every trial at once. returns a dict of arrays with keys
+    start, end, target, path_length, path_efficiency (straight distance / path length, in %) and duration
+    (in samples, or in the units of times if given) """
+    start_inds = np.asarray(start_inds)
+    lasts = np.minimum(end_inds, len(pos)) - 1
+    lengths = path_lengths(pos, start_inds, end_inds)
+    with np.errstate(divide='ignore'):
+        # assume that the cursor starts from the center. This is not always the case however
+        efficiency = target_distance/lengths*100.0
+    if times is None:
+        duration = lasts + 1 - start_inds
+    else:
+        times = np.asarray(times).flatten()
+        duration = times[lasts] - times[start_inds]
+    return {'start': start_inds, 'end': np.asarray(end_inds), 'target': np.asarray(targets),
+            'path_length': lengths, 'path_efficiency': efficiency, 'duration': duration}
+
+def group_by_target(targets, values):
+    """ count, mean and standard deviation of values for every target. returns a dict of arrays with keys
+    target (sorted unique targets), count, mean and std """
+    targets_unique, inverse = np.unique(np.ravel(targets), return_inverse=True)
+    values = np.asarray(values, dtype='float64')
+    count = np.bincount(inverse, minlength=len(targets_unique))
+    mean = np.bincount(inverse, weights=values, minlength=len(targets_unique))/count
+    var = np.bincount(inverse, weights=(values - mean[inverse])**2, minlength=len(targets_unique))/count
+    return {'target': targets_unique, 'count': count, 'mean': mean, 'std': np.sqrt(var)}
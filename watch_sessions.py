@@ -0,0 +1,228 @@
+import pathlib
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import time
+import profiling
+import data_util
+import session_cache
+
+from plot_util import DATA_DIR
+from plot_batch import is_up_to_date, use_file_backend
+
+def session_fingerprint(session_dir):
+    """ size and mtime of a session's task.bin and README.txt, and the newest mtime. None if task.bin is missing """
+    parts = []
+    newest = 0
+    for name in ('task.bin', 'README.txt'):
+        try:
+            stat = os.stat(pathlib.Path(session_dir) / name)
+        except FileNotFoundError:
+            if name == 'task.bin':
+                return None, None
+            continue
+        parts.append(f'{name}|{stat.st_size}|{stat.st_mtime_ns}')
+        newest = max(newest, stat.st_mtime)
+    return ';'.join(parts), newest
+
+def scan(datadir):
+    """ dict of session -> (fingerprint, newest mtime) of every session folder in datadir with a task.bin """
+    sessions = {}
+    for entry in os.scandir(datadir):
+        if entry.is_dir():
+            key, newest = session_fingerprint(entry.path)
+            if key is not None:
+                sessions[entry.name] = (key, newest)
+    return sessions
+
+def process_session(session, datadir=DATA_DIR, render_options=None):
+    """ trial segmentation and metrics (through the session cache) and the trajectory figure of one session.
+    returns a dict with the number of trials and the figure path """
+    from plot_singlesession_trajectories import plot_trajectories, trajectory_plot_path
+    if render_options is None:
+        render_options = {}
+    data_path = pathlib.Path(datadir) / session
+    tables = session_cache.load_session_tables(data_path)
+    plot_path = trajectory_plot_path(session, render_options.get('fmt', 'pdf'))
+    if not is_up_to_date(plot_path, [data_path / 'task.bin', data_path / 'README.txt']):
+        plot_path = plot_trajectories(session, datadir, **render_options)
+    return {'trials': int(len(tables['start'])), 'figure': str(plot_path)}
+
+class _Inotify():
+    # wakes the watcher when files are created or written in datadir or a session folder. needs the optional
+    # inotify_simple package, otherwise the watcher only polls.
+    def __init__(self, datadir):
+        import inotify_simple
+        self.flags = inotify_simple.flags
+        self.inotify = inotify_simple.INotify()
+        self.mask = self.flags.CREATE | self.flags.MOVED_TO | self.flags.CLOSE_WRITE
+        self.watched = set()
+        self.watch(datadir)
+        return
+    def watch(self, path):
+        if str(path) not in self.watched:
+            try:
+                self.inotify.add_watch(str(path), self.mask)
+                self.watched.add(str(path))
+            except OSError:
+                pass
+        return
+    def wait(self, timeout):
+        return len(self.inotify.read(timeout=int(timeout*1000))) > 0
+    def close(self):
+        self.inotify.close()
+
+class SessionWatcher():
+    """ processes the sessions in datadir that are new or changed since they were last processed, as recorded in a
+    state file. at most workers sessions are processed at a time, in a process pool """
+    def __init__(self, datadir=DATA_DIR, state_path=None, workers=2, settle=10.0, render_options=None, use_inotify=True):
+        # state_path: json file of the processed sessions. None uses a file per datadir in the cache folder.
+        # settle: seconds a session's files must be unchanged before it is processed, so that sessions that are still
+        #   being recorded are not processed half-written
+        # render_options: keyword arguments of plot_trajectories (fmt, rasterized, downsample, dpi)
+        self.datadir = pathlib.Path(datadir)
+        if state_path is None:
+            key = hashlib.sha1(str(self.datadir.absolute()).encode('utf-8')).hexdigest()
+            state_path = session_cache.CACHE_DIR / f'watch_state_{key}.json'
+        self.state_path = pathlib.Path(state_path)
+        self.workers = workers
+        self.settle = settle
+        self.render_options = {} if render_options is None else render_options
+        self.state = self._load_state()
+        self.futures = {} # future -> (session, fingerprint)
+        self.pool = None
+        self.inotify = None
+        if use_inotify:
+            try:
+                self.inotify = _Inotify(self.datadir)
+            except (ImportError, OSError):
+                self.inotify = None
+        return
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self):
+        # a crash never leaves a partial state file
+        data_util.atomic_write(self.state_path, lambda f: json.dump(self.state, f, indent=1), mode='w')
+        return
+
+    def pending(self, sessions=None, now=None):
+        """ sessions that are new or changed since they were processed, have settled and are not being processed.
+        sessions: result of scan (None scans datadir) """
+        if sessions is None:
+            sessions = scan(self.datadir)
+        now = time.time() if now is None else now
+        in_flight = {session for session, key in self.futures.values()}
+        return [session for session, (key, newest) in sorted(sessions.items())
+                if self.state.get(session, {}).get('key') != key and session not in in_flight and now - newest >= self.settle]
+
+    def mark_done(self, sessions=None):
+        """ records sessions (None: all current sessions) as processed without processing them, e.g. to only watch for
+        new sessions in an existing archive """
+        for session, (key, newest) in scan(self.datadir).items():
+            if sessions is None or session in sessions:
+                self.state[session] = {'key': key, 'status': 'skipped'}
+        self._save_state()
+        return
+
+    def _collect(self):
+        # records the finished jobs in the state file. returns their (session, result or exception)
+        finished = []
+        for future in [future for future in self.futures if future.done()]:
+            session, key = self.futures.pop(future)
+            try:
+                result = future.result()
+                self.state[session] = {'key': key, 'status': 'ok', 'processed': time.time(), **result}
+                print(f'{session}: {result["trials"]} trials, saved {result["figure"]}')
+            except Exception as e:
+                # recorded with its fingerprint, so that it is retried only once the session changes
+                self.state[session] = {'key': key, 'status': 'failed', 'processed': time.time(), 'error': repr(e)}
+                result = e
+                print(f'{session}: failed with {e!r}')
+            finished.append((session, result))
+        if len(finished) > 0:
+            self._save_state()
+        return finished
+
+    def poll(self):
+        """ collects finished jobs and submits pending sessions while fewer than workers are running.
+        returns the (session, result) of the jobs that finished """
+        finished = self._collect()
+        sessions = scan(self.datadir)
+        if self.inotify is not None:
+            for session in sessions:
+                self.inotify.watch(self.datadir / session)
+        for session in self.pending(sessions):
+            if len(self.futures) >= self.workers:
+                break # the rest waits for the next poll, so that the pool never holds a backlog
+            if self.pool is None:
+                use_file_backend()
+                self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, initializer=use_file_backend)
+            future = self.pool.submit(process_session, session, self.datadir, self.render_options)
+            self.futures[future] = (session, sessions[session][0])
+        return finished
+
+    def wait(self, timeout):
+        # until a job finishes, a file changes (with inotify) or timeout seconds passed
+        if len(self.futures) > 0:
+            concurrent.futures.wait(list(self.futures), timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+        elif self.inotify is not None:
+            self.inotify.wait(timeout)
+        else:
+            time.sleep(timeout)
+        return
+
+    def run(self, interval=30.0, once=False):
+        """ polls every interval seconds (or sooner on a file change) until interrupted. with once, processes the
+        sessions that are pending now and returns """
+        try:
+            while True:
+                self.poll()
+                if once and len(self.futures) == 0:
+                    return
+                self.wait(interval)
+        finally:
+            self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+            self._collect()
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+        return
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datadir', default=str(DATA_DIR), help='folder containing the session folders')
+    parser.add_argument('--state', default=None, help='json file recording the processed sessions (default: in the cache folder)')
+    parser.add_argument('--workers', type=int, default=2, help='number of sessions processed at a time')
+    parser.add_argument('--interval', type=float, default=30.0, help='seconds between scans of the data folder')
+    parser.add_argument('--settle', type=float, default=10.0, help='seconds a session must be unchanged before it is processed')
+    parser.add_argument('--once', action='store_true', help='process the pending sessions and exit')
+    parser.add_argument('--skip-existing', action='store_true', help='mark the sessions already in datadir as processed')
+    parser.add_argument('--no-inotify', action='store_true', help='only poll, even if inotify_simple is installed')
+    parser.add_argument('--format', default='pdf', help='file format of the trajectory figures, e.g. pdf or png')
+    parser.add_argument('--rasterized', action='store_true', help='draw the trajectories as a bitmap inside vector formats')
+    parser.add_argument('--downsample', type=int, default=1, help='only draw every downsample-th cursor position')
+    profiling.add_argument(parser)
+
+    args = parser.parse_args()
+    profiling.from_args(args)
+    render_options = {'fmt': args.format, 'rasterized': args.rasterized, 'downsample': args.downsample}
+    watcher = SessionWatcher(args.datadir, args.state, args.workers, args.settle, render_options, not args.no_inotify)
+    if args.skip_existing:
+        watcher.mark_done()
+    try:
+        watcher.run(args.interval, args.once)
+    except KeyboardInterrupt:
+        pass